@@ -12,6 +12,7 @@
 #
 # Dependencies:
 # - pysam
+# - pandas
 # - HTSeq
 #
 # Usage:
@@ -20,14 +21,189 @@
 #     from SAMParser import getTranscriptcounts
 #     getTranscriptcounts(gtffile='genes.gtf', bamfile='sample.bam')
 #
+# The exon table can also be loaded on its own with `loadGtfExons()`:
+#
+#     from SAMParser import loadGtfExons
+#     exons, genenames = loadGtfExons('genes.gtf')
+#
+# For many samples, `getTranscriptcountsMatrix()` reads the gtf file once and
+# counts the bam files in parallel, writing one genes x samples table:
+#
+#     from SAMParser import getTranscriptcountsMatrix
+#     getTranscriptcountsMatrix('genes.gtf', ['s1.bam', 's2.bam'], processes=8)
+#
+# `getGeneCounts()` counts every read (or read pair) at most once per gene, by overlap
+# with the union of the gene's exons, in one pass over the bam file - with strandedness,
+# mapping quality / flag filters and a policy for multi-mapping and ambiguous reads:
+#
+#     from SAMParser import getGeneCounts
+#     getGeneCounts('genes.gtf', 'sample.bam', stranded='reverse', multimapping='primary')
+#
+# Setting BIOUTILS_PROFILE=report.json (see profiling.py) writes the time spent
+# reading the gtf file, reading the bam file, counting and writing the output.
+#
 # Note:
 # Designed for yeast transcript quantification from aligned BAM files.
 ################################################################################
 
+#Stage timers and counters, switched on with BIOUTILS_PROFILE
+import profiling
+
+
+@profiling.timed("loadGtfExons")
+def loadGtfExons(gtffile, transcript = "1", skip_contigs = ("ChrM", "ChrC"), cache = True):
+    """
+    This function reads a gtf file and returns the exons of one transcript per gene,
+    using whole-column pandas operations instead of going row by row.
+    By default it keeps transcript 1 (Transcript ID =.1) and skips ChrM and ChrC,
+    same as getTranscriptcounts always did.
+
+    Inputs required to run the function:
+    gtffile: Please provide path to gtf file
+    transcript: transcript number to keep (the character after the first "." of the Transcript ID),
+    or None to keep the exons of every transcript
+    skip_contigs: chromosome names to leave out
+    cache: if True (default), the gtf file is read through the on-disk index in annotation_index.py,
+    so only the first run parses the text; if False, it is read with pd.read_csv every time
+    Returns (exons, genenames):
+    exons: pandas data frame with columns contig, start, end, gene (an integer gene code) and strand
+    genenames: array of gene names, genenames[code] is the name for that code, in order of first appearance. """
+
+    import pandas as pd
+
+    if cache:
+        #Taking the exon rows that are not on the skipped chromosomes from the cached index
+        from annotation_index import load_annotation_index
+        index = load_annotation_index(gtffile)
+        rows = index.select(feature = "exon", exclude_contigs = skip_contigs)
+        df = pd.DataFrame({0: index.contig_names(rows),
+                           3: index.start[rows],
+                           4: index.end[rows],
+                           6: index.strand[rows].astype("U1"),
+                           8: index.attributes(rows)})
+    else:
+        #Reading only the columns needed - chr name (0), feature type (2), start (3), stop (4), strand (6) and attributes (8)
+        df = pd.read_csv(gtffile, sep='\t', header=None, usecols=[0, 2, 3, 4, 6, 8],
+                         dtype={0: str, 2: str, 6: str, 8: str})
+
+        #Keeping exon rows that are not on the skipped chromosomes - done for the whole column at once
+        keep = (df[2] == "exon") & ~df[0].isin(list(skip_contigs))
+        df = df[keep]
+
+    #Splitting column 8 by ; only once for the rows that are left
+    #The 0th element has the Transcript ID, the 1st element has the gene name
+    attributes = df[8].str.split(";")
+
+    #Transcript number is the first character after the first . of the Transcript ID
+    if transcript is not None:
+        transcript_number = attributes.str[0].str.split(".").str[1].str[0]
+        selected = (transcript_number == transcript).to_numpy()
+        df = df[selected]
+        attributes = attributes[selected]
+
+    #Gene name is the 2nd element after splitting by space, same as before
+    genenames = attributes.str[1].str.split(" ").str[2].str.strip()
 
+    #An exon without a gene name would get code -1 from factorize and be counted for another gene
+    missing = genenames.isna().to_numpy()
+    if missing.any():
+        row = df[missing].iloc[0]
+        raise ValueError("%s: exon at %s:%s-%s has no gene name in its attributes: %r"
+                         % (gtffile, row[0], row[3], row[4], row[8]))
 
+    #Turning gene names into integer codes, so the exon table stays small
+    codes, uniques = pd.factorize(genenames)
 
-def getTranscriptcounts(gtffile,bamfile, outputfile = "counts.txt" ):
+    exons = pd.DataFrame({"contig": df[0].to_numpy(),
+                          "start": df[3].to_numpy(dtype="int64"),
+                          "end": df[4].to_numpy(dtype="int64"),
+                          "gene": codes.astype("int32"),
+                          "strand": df[6].to_numpy()})
+    profiling.count_file("gtf_bytes", gtffile)
+    profiling.count("exons", len(exons))
+    return exons, uniques.to_numpy()
+
+
+#Reads whose positions getExonCounts holds in memory at once, per contig
+EXON_COUNT_CHUNK = 1 << 20
+
+
+@profiling.timed("getExonCounts")
+def getExonCounts(bam_samplefile, exons):
+    """
+    This function counts reads overlapping each exon in a single forward pass
+    over every contig of a coordinate-sorted, indexed bam file, holding only a
+    chunk of EXON_COUNT_CHUNK read positions in memory at a time.
+    It gives the same numbers as calling bam_samplefile.count(contig, start, stop)
+    once per exon, without re-seeking the bam index for every exon.
+
+    Inputs required to run the function:
+    bam_samplefile: an open pysam.AlignmentFile (sorted and indexed)
+    exons: list of (contig, start, stop) tuples, in any order
+    Returns a list of counts, in the same order as exons. """
+
+    from array import array
+    import numpy as np
+
+    counts = [0] * len(exons)
+
+    #Grouping the exon indices by contig, so each contig is only read once
+    by_contig = {}
+    for i, (contig, start, stop) in enumerate(exons):
+        by_contig.setdefault(contig, []).append(i)
+
+    for contig, indices in by_contig.items():
+
+        #A read overlaps region [start, stop) when read_start < stop and read_end > start - same rule pysam uses.
+        #Overlapping reads = (reads starting before stop) - (reads ending at or before start);
+        #the second group is always inside the first, because a read ends after it starts.
+        #Each read adds 1 to a histogram over the sorted exon stops (and starts) at the first exon it counts for,
+        #so a running sum over the histogram gives both numbers for every exon, and memory grows with exons, not reads.
+        stops = np.array([exons[i][2] for i in indices], dtype=np.int64)
+        starts = np.array([exons[i][1] for i in indices], dtype=np.int64)
+        by_stop = np.argsort(stops, kind="stable")
+        by_start = np.argsort(starts, kind="stable")
+        sorted_stops, sorted_starts = stops[by_stop], starts[by_start]
+        started = np.zeros(len(indices) + 1, dtype=np.int64)
+        ended = np.zeros(len(indices) + 1, dtype=np.int64)
+
+        def add_reads(read_starts, read_ends):
+            #Reads starting before stop are counted from the first exon whose stop is above the read start,
+            #reads ending at or before start from the first exon whose start is at or above the read end
+            read_starts = np.frombuffer(read_starts, dtype=np.int64)
+            read_ends = np.frombuffer(read_ends, dtype=np.int64)
+            started[:] += np.bincount(np.searchsorted(sorted_stops, read_starts, side="right"), minlength=len(started))
+            ended[:] += np.bincount(np.searchsorted(sorted_starts, read_ends, side="left"), minlength=len(ended))
+
+        #One pass over the reads of this contig, keeping the start and end positions of one chunk of reads at a time.
+        #Unmapped reads placed on the contig have no reference_end, for those pysam uses read_start + 1.
+        nreads = 0
+        read_starts = array("q")
+        read_ends = array("q")
+        with profiling.stage("read_bam"):
+            for read in bam_samplefile.fetch(contig):
+                read_starts.append(read.reference_start)
+                read_ends.append(read.reference_end or read.reference_start + 1)
+                if len(read_starts) == EXON_COUNT_CHUNK:
+                    add_reads(read_starts, read_ends)
+                    nreads += len(read_starts)
+                    read_starts = array("q")
+                    read_ends = array("q")
+            add_reads(read_starts, read_ends)
+            nreads += len(read_starts)
+        profiling.count("reads", nreads)
+
+        contig_counts = np.empty(len(indices), dtype=np.int64)
+        contig_counts[by_stop] = np.cumsum(started)[:-1]
+        contig_counts[by_start] -= np.cumsum(ended)[:-1]
+        for i, count in zip(indices, contig_counts.tolist()):
+            counts[i] = count
+
+    return counts
+
+
+@profiling.timed("getTranscriptcounts")
+def getTranscriptcounts(gtffile,bamfile, outputfile = "counts.txt", method = "sweep" ):
     """
     This function is used to obtain Transcript counts for protein coding genes. 
     It accounts only for transcript 1; and not other splicing variants.
@@ -36,13 +212,14 @@ def getTranscriptcounts(gtffile,bamfile, outputfile = "counts.txt" ):
     gtffile: Please provide path to gtf file
     bamfile: Please provide path to bam file
     output file: Default output for this function is counts.txt file; 
-    if you need to change - please provide output path. """
+    if you need to change - please provide output path.
+    method: "sweep" (default) counts all exons in one pass over each contig with getExonCounts;
+    "count" calls bam_samplefile.count() once per exon (slower, kept for checking). """
     
     #####----IMPORTING REQUIRED MODULES-------------###############
     ##Reading the bam file with pysam 
     #Importing packages:
     print("Importing required modules...")
-    import pandas as pd
     import pysam
 
     #####----READING THE TWO FILES-------------###############
@@ -50,81 +227,369 @@ def getTranscriptcounts(gtffile,bamfile, outputfile = "counts.txt" ):
     #Saving it with a variable name
     print("Reading bam file...")
     bam_samplefile = pysam.AlignmentFile(bamfile, "r" )
+    profiling.count_file("bam_bytes", bamfile)
     
     
-    #Viewing the gtf file using pandas 
-    #It is a tab separated file so using that as the delimiter and keeping header as none 
-    #Saving with a variable name
+    #Reading the gtf file with loadGtfExons 
+    #It keeps exons of transcript .1 outside ChrM and ChrC and gives each gene an integer code
     print("Reading gtf file")
-    df = pd.read_csv(gtffile,sep='\t',header= None)
+    exons, genenames = loadGtfExons(gtffile)
     
     #####----CALCULATING TRANSCRIPT COUNTS-------------###############
     print("Calculating Transcript counts for genes...")
-    
-    #Making empty pandas data frame - so that it can be populated in the for loop below
-    my_dict = {}
-    count = []
-    
-    #Iterating over the range of gtf file(stored as df)
-    #For each row in df
-    
-    for i in range(len(df)):
-
-    #I am only interested in the gtf rows with exons, 
-    #so saying for each row and 2nd column - if it has the word exon then do the below
-        if df.iloc[i,2] == "exon" :
-            #Also the gtf file has data for ChrM and ChrC - Manny said to iterate only for Chr 1-5 
-            #So asking it to check chromosome name, and if it is not ChrM or ChrC, then to do the stuff below
-            if (df.iloc[i,0] != "ChrM"):
-                if (df.iloc[i,0] != "ChrC"):
-
-                    #Then since I am interested only in transcript 1(ie Transcript ID =.1) 
-                    #I am asking it for every row i - to split column 8 (which has Transcript ID and genename)
-                    #First spliting by ; and then retriving the 0th element 
-                    #Further spliting that by . and retriving the 1st element
-                    #That contains 1" or 2", etc. - and I want only the 1/2/etc. not the " - so again getting the 0th element
-                    #Wrapping all this in an if statement and saying if that value is 1 - which stands for the first transcript (.1)
-                    #Then do the stuff below
-                    if (((df.iloc[i,8].split(";")[0]).split(".")[1])[0]) == "1":
-
-                    #Then for those rows, I want to get the counts from bam file
-                    #For each row, use the chromosome name from the gtf file as the contig. The chr name is column 0 (python is 0 based)
-                    #Similary for each row, use the start from the gtf file - start is in column 3
-                    #Similary for each row, use the stop from the gtf file - start is in column 3
-                        count =  bam_samplefile.count(contig =df.iloc[i,0], start = df.iloc[i,3] , stop= df.iloc[i,4])
-
-
-               #For same row (i), I also am appending the Genename - which is stored in the last column; to the pandas dataframe under the column Genename
-               #Since the last column has a bunch of other stuff, I am spliting first by ; and retriving the 1st element
-               #Then again splitting the above by space and picking the 2nd element. Which is the gene name    
-                        Genename = ((df.iloc[i,8].split(";")[1]).split(" ")[2]).strip()
-
-                #Putting it in a dictionary called my_dict:
-                #With genename as key and count as value
-                #With if statement saying if Genename is present as key already - then add this value of count and sum it (basically like append)
-                        if Genename in my_dict:
-                            my_dict[Genename] += count 
-                 #If genename is present, then just put in the count value       
-                        else:
-                            my_dict[Genename]= count
+    regions = list(zip(exons["contig"], exons["start"].tolist(), exons["end"].tolist()))
+
+    #Getting the counts for every selected exon from the bam file
+    if method == "sweep":
+        #One forward pass over each contig for all exons at once
+        counts = getExonCounts(bam_samplefile, regions)
+    elif method == "count":
+        #One indexed count() call per exon
+        with profiling.stage("count_per_exon"):
+            counts = [bam_samplefile.count(contig = contig, start = start, stop = stop) for contig, start, stop in regions]
+    else:
+        raise ValueError("method should be 'sweep' or 'count', not %r" % (method,))
+
+    #Adding up the exon counts for each gene code, and putting it in a dictionary called my_dict:
+    #With genename as key and count as value, genes stay in the order they first appear in the gtf file
+    gene_totals = [0] * len(genenames)
+    for code, count in zip(exons["gene"].tolist(), counts):
+        gene_totals[code] += count
+    my_dict = dict(zip(genenames, gene_totals))
                                 
     print("Finished calculating transcript counts for protein coding genes (With Transcript .1).")
     print("Creating the output file...")
     
     #Saving the output as a txt file- opening and writing in it                        
-    file = open(outputfile,"w")
+    with profiling.stage("write_output"):
+        file = open(outputfile,"w")
 
-    #Saying for key and values in the dictionary:
-    for key, value in my_dict.items(): 
-        #Write key and value - seperated by a tab; and putting "\n" so the next entry can begin in new line.
-        file.write('%s\t%s\n' % (key,value))
+        #Saying for key and values in the dictionary:
+        for key, value in my_dict.items(): 
+            #Write key and value - seperated by a tab; and putting "\n" so the next entry can begin in new line.
+            file.write('%s\t%s\n' % (key,value))
 
-    #Closing the output file
-    file.close()
+        #Closing the output file
+        file.close()
+    profiling.count("genes", len(my_dict))
     print("Output file with transcript counts has been created successfully!")
 
 
 
     
     
-    
\ No newline at end of file
+    #####----COUNTING MANY BAM FILES AT ONCE-------------###############
+#The exon regions are set once per worker process by _initCountWorker, so they are
+#not pickled again for every task. With the fork start method they are simply shared.
+_worker_regions = None
+_worker_by_contig = None
+
+
+def _initCountWorker(regions):
+    global _worker_regions, _worker_by_contig
+    _worker_regions = regions
+    _worker_by_contig = {}
+    for i, (contig, start, stop) in enumerate(regions):
+        _worker_by_contig.setdefault(contig, []).append(i)
+
+
+def _countWorker(task):
+    #One task is one bam file, and either all contigs (contig is None) or just one contig
+    import pysam
+    sample, bamfile, contig = task
+    if contig is None:
+        indices = list(range(len(_worker_regions)))
+    else:
+        indices = _worker_by_contig[contig]
+    with pysam.AlignmentFile(bamfile, "r") as bam_samplefile:
+        counts = getExonCounts(bam_samplefile, [_worker_regions[i] for i in indices])
+    return sample, indices, counts
+
+
+@profiling.timed("getTranscriptcountsMatrix")
+def getTranscriptcountsMatrix(gtffile, bamfiles, outputfile = "counts_matrix.txt",
+                              processes = None, per_contig = False, samplenames = None):
+    """
+    This function is used to obtain Transcript counts for many bam files against the same gtf file.
+    The gtf file is read only once and the bam files are counted in a pool of processes.
+    It gives the same numbers as calling getTranscriptcounts once per bam file.
+    
+    Inputs required to run the function:
+    gtffile: Please provide path to gtf file
+    bamfiles: Please provide a list of paths to (sorted and indexed) bam files
+    outputfile: Default output is counts_matrix.txt - a tab separated table with one row per gene
+    and one column per sample; if you need to change - please provide output path (None to skip writing).
+    processes: number of worker processes, default is the number of cores
+    per_contig: if True, every contig of every bam file is its own task - helps when there are fewer samples than cores
+    samplenames: column names for the samples, default is the bam file name without .bam
+    Returns the counts matrix as a pandas data frame (genes x samples). """
+
+    import csv
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+    import numpy as np
+    import pandas as pd
+
+    bamfiles = list(bamfiles)
+    if samplenames is None:
+        samplenames = [os.path.basename(bamfile).rsplit(".bam", 1)[0] for bamfile in bamfiles]
+    if len(samplenames) != len(bamfiles):
+        raise ValueError("samplenames should have one name per bam file")
+
+    #Reading the gtf file only once for all samples
+    print("Reading gtf file")
+    exons, genenames = loadGtfExons(gtffile)
+    regions = list(zip(exons["contig"], exons["start"].tolist(), exons["end"].tolist()))
+    gene_codes = exons["gene"].to_numpy()
+
+    #Making the list of tasks - one per sample, or one per sample and contig
+    if per_contig:
+        contigs = list(dict.fromkeys(exons["contig"]))
+        tasks = [(sample, bamfile, contig) for sample, bamfile in enumerate(bamfiles) for contig in contigs]
+    else:
+        tasks = [(sample, bamfile, None) for sample, bamfile in enumerate(bamfiles)]
+
+    print("Calculating Transcript counts for %d bam files..." % len(bamfiles))
+    matrix = np.zeros((len(genenames), len(bamfiles)), dtype="int64")
+    with profiling.stage("count_pool"), \
+            ProcessPoolExecutor(max_workers = processes, initializer = _initCountWorker,
+                                initargs = (regions,)) as pool:
+        for sample, indices, counts in pool.map(_countWorker, tasks):
+            #Adding the exon counts into the gene row of this sample's column
+            np.add.at(matrix[:, sample], gene_codes[indices], counts)
+    for bamfile in bamfiles:
+        profiling.count_file("bam_bytes", bamfile)
+    profiling.count("samples", len(bamfiles))
+
+    df = pd.DataFrame(matrix, index = pd.Index(genenames, name = "gene"), columns = samplenames)
+    print("Finished calculating transcript counts for protein coding genes (With Transcript .1).")
+
+    if outputfile is not None:
+        print("Creating the output file...")
+        #No quoting, so gene names are written the same way as in counts.txt
+        with profiling.stage("write_output"):
+            df.to_csv(outputfile, sep = "\t", quoting = csv.QUOTE_NONE)
+        print("Output file with the transcript counts matrix has been created successfully!")
+    return df
+
+
+    #####----COUNTING EACH READ ONCE PER GENE-------------###############
+#Options of getGeneCounts
+STRANDED = ("no", "yes", "reverse")
+MULTIMAPPING = ("unique", "primary", "all", "fraction")
+AMBIGUOUS = ("none", "all", "fraction")
+
+#Extra lines at the end of the getGeneCounts output, for reads (or pairs) not given to any gene
+SPECIAL_COUNTERS = ("__no_feature", "__ambiguous", "__too_low_aQual", "__not_aligned",
+                    "__alignment_not_unique", "__filtered")
+
+
+@profiling.timed("buildGeneSteps")
+def buildGeneSteps(exons, stranded = "no"):
+    """
+    This function turns the exon table from loadGtfExons into a lookup of which genes cover each stretch
+    of a chromosome (the union of each gene's exons). Every chromosome (and strand, unless stranded is "no")
+    is cut at every exon start and end; each piece between two cuts has the set of genes whose exons cover it.
+
+    Inputs required to run the function:
+    exons: data frame from loadGtfExons (columns contig, start, end, gene and strand)
+    stranded: "no" puts both strands together; "yes" or "reverse" keeps + and - strand genes apart
+    Returns a dictionary of (contig, strand) -> (cuts, genesets), strand being "." when stranded is "no".
+    genesets[i] is the frozenset of gene codes covering [cuts[i], cuts[i + 1]) in 0-based coordinates,
+    so gtf exon start..end (1-based, inclusive) becomes [start - 1, end). """
+
+    #Start and end of every exon, grouped by chromosome and strand
+    events = {}
+    strands = exons["strand"] if stranded != "no" else ["."] * len(exons)
+    for contig, strand, start, end, gene in zip(exons["contig"], strands, exons["start"].tolist(),
+                                                exons["end"].tolist(), exons["gene"].tolist()):
+        group = events.setdefault((contig, strand), [])
+        group.append((start - 1, 1, gene))
+        group.append((end, -1, gene))
+
+    steps = {}
+    shared = {}
+    for key, group in events.items():
+        group.sort()
+        cuts, genesets = [], []
+        covering = {}
+        for i, (position, change, gene) in enumerate(group):
+            #A gene can have overlapping exons (from different transcripts), so exons are counted per gene
+            covering[gene] = covering.get(gene, 0) + change
+            if covering[gene] == 0:
+                del covering[gene]
+            if i + 1 < len(group) and group[i + 1][0] == position:
+                continue
+            #Equal gene sets are kept as one frozenset, so big annotations do not repeat them
+            geneset = frozenset(covering)
+            geneset = shared.setdefault(geneset, geneset)
+            if genesets and genesets[-1] is geneset:
+                continue
+            cuts.append(position)
+            genesets.append(geneset)
+        steps[key] = (cuts, genesets)
+    return steps
+
+
+def _genesForBlocks(steps, key, blocks):
+    #Union of the gene sets of every piece touched by the aligned blocks of one read
+    from bisect import bisect_right
+    found = steps.get(key)
+    if found is None:
+        return frozenset()
+    cuts, genesets = found
+    genes = set()
+    for start, end in blocks:
+        i = bisect_right(cuts, start) - 1
+        if i < 0:
+            i = 0
+        while i < len(cuts) and cuts[i] < end:
+            genes |= genesets[i]
+            i += 1
+    return genes
+
+
+@profiling.timed("getGeneCounts")
+def getGeneCounts(gtffile, bamfile, outputfile = "gene_counts.txt", stranded = "no", min_mapq = 10,
+                  exclude_flags = 0x200, multimapping = "unique", ambiguous = "none",
+                  transcript = None, skip_contigs = ("ChrM", "ChrC")):
+    """
+    This function is used to obtain gene counts where every read (or read pair) is given to a gene at most once.
+    A read belongs to a gene when any of its aligned bases falls on one of the gene's exons (union of the exons
+    of all its transcripts) - so a read spanning two exons of a gene counts once, not twice as in getTranscriptcounts.
+    Reads whose bases fall on the exons of more than one gene are ambiguous.
+    The bam file is read once, start to end, and does not need an index.
+    Paired reads are counted once per pair: the two mates are joined by read name as the file is read.
+    
+    Inputs required to run the function:
+    gtffile: Please provide path to gtf file
+    bamfile: Please provide path to bam file
+    outputfile: Default output for this function is gene_counts.txt - gene and count, tab separated, followed by the
+    lines of SPECIAL_COUNTERS (reads not given to any gene, like htseq-count); None to skip writing.
+    stranded: "no" (default) - reads count on genes of either strand; "yes" - the read (first mate of a pair) must be on
+    the gene's strand; "reverse" - it must be on the opposite strand (e.g. dUTP / TruSeq stranded libraries)
+    min_mapq: reads with a lower mapping quality go to __too_low_aQual (default 10)
+    exclude_flags: reads with any of these SAM flag bits go to __filtered (default 0x200, failed QC; add 0x400 to drop
+    duplicates). Supplementary alignments (0x800) are always skipped, the primary alignment stands for the read.
+    multimapping: what to do with reads aligned to more than one place (NH tag above 1, or secondary alignments):
+    "unique" (default) - count none of them, they go to __alignment_not_unique; "primary" - count only the primary
+    alignment; "all" - count every alignment; "fraction" - every alignment counts 1/NH
+    ambiguous: what to do with reads on more than one gene: "none" (default) - they go to __ambiguous;
+    "all" - every gene gets 1; "fraction" - every gene gets 1/(number of genes)
+    transcript: None (default) to use the exons of every transcript; "1" to use only transcript .1, as getTranscriptcounts does
+    skip_contigs: chromosome names whose genes are left out
+    Returns a dictionary of gene name -> count, with the SPECIAL_COUNTERS at the end. """
+
+    import pysam
+
+    for name, value, choices in (("stranded", stranded, STRANDED), ("multimapping", multimapping, MULTIMAPPING),
+                                 ("ambiguous", ambiguous, AMBIGUOUS)):
+        if value not in choices:
+            raise ValueError("%s should be one of %s, not %r" % (name, ", ".join(map(repr, choices)), value))
+
+    print("Reading gtf file")
+    exons, genenames = loadGtfExons(gtffile, transcript = transcript, skip_contigs = skip_contigs)
+    steps = buildGeneSteps(exons, stranded)
+
+    fractional = multimapping == "fraction" or ambiguous == "fraction"
+    counts = [0.0 if fractional else 0] * len(genenames)
+    special = dict.fromkeys(SPECIAL_COUNTERS, 0)
+
+    def assign(status, genes, weight):
+        #Final decision for one read, or one pair of reads
+        if status is not None:
+            special[status] += 1
+        elif not genes:
+            special["__no_feature"] += 1
+        elif len(genes) == 1:
+            for gene in genes:
+                counts[gene] += weight
+        elif ambiguous == "none":
+            special["__ambiguous"] += 1
+        else:
+            share = weight / len(genes) if ambiguous == "fraction" else weight
+            for gene in genes:
+                counts[gene] += share
+
+    #First mates waiting for the second one: (name, hit index, secondary) -> (status, genes, weight)
+    waiting = {}
+    alignments = 0
+
+    print("Calculating gene counts...")
+    with profiling.stage("count_reads"), pysam.AlignmentFile(bamfile, "r") as bam_samplefile:
+        for read in bam_samplefile.fetch(until_eof = True):
+            alignments += 1
+            flag = read.flag
+            if flag & 0x800:
+                continue
+            paired = flag & 0x1
+
+            if flag & 0x4:
+                #Unmapped - counted once: for a pair, only when both mates are unmapped (by the first mate),
+                #otherwise the mapped mate stands for the pair
+                if not paired or (flag & 0x8 and flag & 0x40):
+                    special["__not_aligned"] += 1
+                continue
+
+            #Working out what this alignment says on its own: (status, genes, weight)
+            if flag & exclude_flags:
+                status, genes, weight = "__filtered", None, 1
+            elif flag & 0x100 and multimapping == "primary":
+                continue
+            else:
+                nh = read.get_tag("NH") if read.has_tag("NH") else 1
+                multi = nh > 1 or flag & 0x100
+                if multi and multimapping == "unique":
+                    status, genes, weight = "__alignment_not_unique", None, 1
+                elif read.mapping_quality < min_mapq:
+                    status, genes, weight = "__too_low_aQual", None, 1
+                else:
+                    status = None
+                    weight = 1.0 / nh if multi and multimapping == "fraction" else 1
+                    if stranded == "no":
+                        strand = "."
+                    else:
+                        #The strand of the fragment is the strand of the first mate; the second mate is flipped
+                        reverse = bool(flag & 0x10) != bool(paired and flag & 0x80)
+                        if stranded == "reverse":
+                            reverse = not reverse
+                        strand = "-" if reverse else "+"
+                    genes = _genesForBlocks(steps, (read.reference_name, strand), read.get_blocks())
+
+            if not paired or flag & 0x8:
+                assign(status, genes, weight)
+                continue
+
+            #Paired read with a mapped mate - keeping it until the mate comes, then deciding for both
+            key = (read.query_name, read.get_tag("HI") if read.has_tag("HI") else None, flag & 0x100)
+            mate = waiting.pop(key, None)
+            if mate is None:
+                waiting[key] = (status, genes, weight)
+                continue
+            mate_status, mate_genes, mate_weight = mate
+            if status is None and mate_status is None:
+                assign(None, genes | mate_genes, weight)
+            else:
+                assign(status or mate_status, None, weight)
+
+    #Mates that never came (e.g. dropped from the file) - the read counts on its own
+    for status, genes, weight in waiting.values():
+        assign(status, genes, weight)
+
+    profiling.count_file("bam_bytes", bamfile)
+    profiling.count("alignments", alignments)
+
+    my_dict = dict(zip(genenames, counts))
+    my_dict.update(special)
+    print("Finished calculating gene counts.")
+
+    if outputfile is not None:
+        print("Creating the output file...")
+        with profiling.stage("write_output"), open(outputfile, "w") as file:
+            if fractional:
+                file.write("".join("%s\t%.3f\n" % (gene, count) for gene, count in zip(genenames, counts)))
+            else:
+                file.write("".join("%s\t%d\n" % (gene, count) for gene, count in zip(genenames, counts)))
+            file.write("".join("%s\t%d\n" % item for item in special.items()))
+        print("Output file with gene counts has been created successfully!")
+    return my_dict
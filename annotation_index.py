@@ -0,0 +1,250 @@
+"""
+annotation_index.py — Cached Binary Index for GTF/GFF Annotation Files
+
+Description:
+This module turns a GTF or GFF annotation file into a set of compact numpy
+array columns (chromosome, feature type, start, end, strand and the raw
+attribute strings) and saves them on disk. The first call for a file builds
+the index; later calls memory-map the saved arrays instead of parsing the
+text again. The index is keyed by the file's path, size and modification
+time, so it is rebuilt automatically when the annotation file changes.
+
+It is shared by SAMParser.py and gffparser.py.
+
+Usage:
+>>> from annotation_index import load_annotation_index
+>>> idx = load_annotation_index("genes.gtf")
+>>> rows = idx.select(feature="exon", contig="Chr1")
+>>> idx.attribute(rows[0])
+
+The cache lives in ~/.cache/python-bio-utils unless the BIOUTILS_CACHE_DIR
+environment variable (or the cachedir argument) says otherwise.
+
+Dependencies:
+    - numpy
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import profiling
+
+#Bump this when the saved layout changes, so old caches are rebuilt instead of misread
+INDEX_VERSION = 1
+
+#Array columns saved for every index, one .npy file each
+COLUMNS = ("contig", "type", "start", "end", "strand", "attr_offsets", "attr_blob")
+
+
+def default_cachedir():
+    """Return the directory where annotation indexes are kept."""
+    return os.environ.get("BIOUTILS_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "python-bio-utils"))
+
+
+def _source_key(path):
+    #What the cache is checked against - if any of it changes, the index is rebuilt
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns, "version": INDEX_VERSION}
+
+
+def _index_dir(path, cachedir):
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(cachedir, name + "-" + os.path.basename(path) + ".idx")
+
+
+class AnnotationIndex:
+    """Column arrays for every feature line of an annotation file.
+
+    contig and type are integer codes into the contignames and typenames lists,
+    start and end are the coordinates as written in the file (1-based, inclusive),
+    strand is the strand character as a byte, and the attribute string of row i
+    is attr_blob[attr_offsets[i]:attr_offsets[i + 1]]."""
+
+    def __init__(self, columns, contignames, typenames):
+        self.contig = columns["contig"]
+        self.type = columns["type"]
+        self.start = columns["start"]
+        self.end = columns["end"]
+        self.strand = columns["strand"]
+        self.attr_offsets = columns["attr_offsets"]
+        self.attr_blob = columns["attr_blob"]
+        self.contignames = list(contignames)
+        self.typenames = list(typenames)
+
+    def __len__(self):
+        return len(self.start)
+
+    def contig_code(self, name):
+        """Return the integer code of a chromosome name, or -1 if it is not in the file."""
+        try:
+            return self.contignames.index(name)
+        except ValueError:
+            return -1
+
+    def type_code(self, name):
+        """Return the integer code of a feature type, or -1 if it is not in the file."""
+        try:
+            return self.typenames.index(name)
+        except ValueError:
+            return -1
+
+    def mask(self, feature=None, contig=None, exclude_contigs=()):
+        """Return a boolean array marking rows with the given feature type and chromosome."""
+        import numpy as np
+        keep = np.ones(len(self), dtype=bool)
+        if feature is not None:
+            keep &= self.type == self.type_code(feature)
+        if contig is not None:
+            keep &= self.contig == self.contig_code(contig)
+        for name in exclude_contigs:
+            keep &= self.contig != self.contig_code(name)
+        return keep
+
+    def select(self, feature=None, contig=None, exclude_contigs=()):
+        """Return the row numbers with the given feature type and chromosome."""
+        import numpy as np
+        return np.flatnonzero(self.mask(feature, contig, exclude_contigs))
+
+    def attribute(self, i):
+        """Return the attribute string (column 9) of row i."""
+        return bytes(self.attr_blob[self.attr_offsets[i]:self.attr_offsets[i + 1]]).decode()
+
+    def attributes(self, rows):
+        """Return the attribute strings of several rows as a list."""
+        blob = memoryview(self.attr_blob)
+        offsets = self.attr_offsets
+        return [bytes(blob[offsets[i]:offsets[i + 1]]).decode() for i in rows]
+
+    def contig_names(self, rows):
+        """Return the chromosome names of several rows as a list."""
+        names = self.contignames
+        return [names[code] for code in self.contig[rows].tolist()]
+
+
+@profiling.timed("build_annotation_index")
+def build_annotation_index(path):
+    """Parse a GTF/GFF file into an AnnotationIndex held in memory.
+
+    The file may be plain text or gzip/bgzip compressed. Comment lines are
+    skipped and parsing stops at a ##FASTA section."""
+    import numpy as np
+
+    contigcodes = {}
+    typecodes = {}
+    contig, ftype, start, end, strand = [], [], [], [], []
+    offsets = [0]
+    blob = bytearray()
+
+    with open(path, "rb") as probe:
+        gzipped = probe.read(2) == b"\x1f\x8b"
+
+    with (gzip.open(path, "rb") if gzipped else open(path, "rb")) as f:
+        for line in f:
+            if line.startswith(b"#"):
+                if line.startswith(b"##FASTA"):
+                    break
+                continue
+            fields = line.rstrip(b"\r\n").split(b"\t", 8)
+            if len(fields) < 8:
+                continue
+            contig.append(contigcodes.setdefault(fields[0].decode(), len(contigcodes)))
+            ftype.append(typecodes.setdefault(fields[2].decode(), len(typecodes)))
+            start.append(int(fields[3]))
+            end.append(int(fields[4]))
+            strand.append(fields[6][:1] or b".")
+            if len(fields) > 8:
+                blob += fields[8]
+            offsets.append(len(blob))
+
+    columns = {
+        "contig": np.array(contig, dtype=np.int32),
+        "type": np.array(ftype, dtype=np.int16),
+        "start": np.array(start, dtype=np.int64),
+        "end": np.array(end, dtype=np.int64),
+        "strand": np.array(strand, dtype="S1"),
+        "attr_offsets": np.array(offsets, dtype=np.int64),
+        "attr_blob": np.frombuffer(bytes(blob), dtype=np.uint8),
+    }
+    profiling.count_file("annotation_bytes_parsed", path)
+    profiling.count("annotation_features", len(start))
+    return AnnotationIndex(columns, list(contigcodes), list(typecodes))
+
+
+@profiling.timed("save_annotation_index")
+def save_annotation_index(index, path, cachedir=None):
+    """Write an index for the annotation file at path into the cache directory."""
+    import numpy as np
+
+    cachedir = cachedir or default_cachedir()
+    os.makedirs(cachedir, exist_ok=True)
+    target = _index_dir(path, cachedir)
+
+    #Writing into a temporary directory first, so a half-written index is never picked up
+    tmp = tempfile.mkdtemp(dir=cachedir, prefix=".building-")
+    try:
+        for name in COLUMNS:
+            np.save(os.path.join(tmp, name + ".npy"), getattr(index, name))
+        meta = {"source": _source_key(path), "contignames": index.contignames,
+                "typenames": index.typenames}
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.replace(tmp, target)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return target
+
+
+def load_annotation_index(path, cachedir=None, rebuild=False):
+    """Return the AnnotationIndex for a GTF/GFF file, memory-mapped from the cache.
+
+    The index is built and saved first if there is none yet, if the file's
+    path, size or modification time changed, or if rebuild is True. If the
+    cache directory cannot be written, or another process building the same
+    file replaces the saved copy meanwhile, the freshly built index is
+    returned from memory instead."""
+
+    cachedir = cachedir or default_cachedir()
+    target = _index_dir(path, cachedir)
+    metafile = os.path.join(target, "meta.json")
+
+    if not rebuild and os.path.exists(metafile):
+        #Another process saving the same file may remove the directory in between - then it is built again
+        try:
+            with open(metafile) as f:
+                meta = json.load(f)
+            if meta.get("source") == _source_key(path):
+                index = _open_index(target, meta)
+                profiling.count("annotation_index_hits")
+                return index
+        except OSError:
+            pass
+
+    profiling.count("annotation_index_misses")
+
+    index = build_annotation_index(path)
+    try:
+        save_annotation_index(index, path, cachedir)
+    except OSError:
+        return index
+    #Memory-mapping the saved copy, unless another process building the same file has replaced it meanwhile
+    try:
+        with open(metafile) as f:
+            return _open_index(target, json.load(f))
+    except OSError:
+        return index
+
+
+def _open_index(target, meta):
+    import numpy as np
+    columns = {name: np.load(os.path.join(target, name + ".npy"), mmap_mode="r")
+               for name in COLUMNS}
+    return AnnotationIndex(columns, meta["contignames"], meta["typenames"])
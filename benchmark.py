@@ -0,0 +1,610 @@
+"""
+benchmark.py — Benchmarks for the Parsing and Counting Hot Paths
+
+Description:
+This script makes deterministic synthetic data (GTF/GFF, BAM, BLAST XML and
+tabular output, FASTA, and an SQLite annotation database) at several sizes
+and times the main functions of the other tools on it:
+
+- SAMParser:              getTranscriptcounts (sweep and per-exon count), getGeneCounts
+- homology:               getBestHomolog, getBestHomologStreaming, getBestHomologTabular,
+                          getReciprocalBestHomology
+- seq_tools:              fasta_load, fasta_iter, Sequence.get_long/convert, IndexedFasta.fetch
+- gffparser:              gene_names_in_region (cached and plain text), RegionIndex queries
+- gene_annotation_search: keyword_search, fts_search, batch_search
+
+Each benchmark runs in its own process and reports wall time (best and
+median of several runs), throughput (items per second), the peak memory
+allocated by Python (tracemalloc) and the peak resident memory of the
+process (after one untimed warm-up run). Results are written as JSON so two runs can be compared.
+
+The same seed and sizes always give the same data. Benchmarks whose
+dependencies are missing (pysam, Biopython, pandas, numpy) are skipped.
+
+Usage:
+    python benchmark.py --sizes 1000,10000 -o before.json
+    python benchmark.py --sizes 1000,10000 -o after.json --compare before.json
+    python benchmark.py --only fasta,blast --repeat 5
+"""
+
+import json
+import os
+import random
+import sys
+
+#Folder of this file, so the tools can be imported wherever the script is run from
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CONTIGS = ("Chr1", "Chr2", "Chr3")
+
+
+#####----SYNTHETIC DATA-------------###############
+
+def make_gtf(path, n_genes, seed=1):
+    """GTF with n_genes genes, each with transcripts .1 and .2 of 1-4 exons, plus a few ChrM genes."""
+    rnd = random.Random(seed)
+    with open(path, "w") as f:
+        per_contig = max(n_genes // len(CONTIGS), 1)
+        gene = 0
+        for contig in CONTIGS + ("ChrM",):
+            pos = 100
+            for _ in range(per_contig if contig != "ChrM" else 3):
+                gene += 1
+                name = "G%06d" % gene
+                strand = rnd.choice("+-")
+                for transcript in (1, 2):
+                    start = pos
+                    tid = '%s.%d' % (name, transcript)
+                    f.write('%s\tbench\ttranscript\t%d\t%d\t.\t%s\t.\ttranscript_id "%s"; gene_id "%s";\n'
+                            % (contig, start, start + 2000, strand, tid, name))
+                    for _ in range(rnd.randint(1, 4)):
+                        exon_start = start + rnd.randint(0, 200)
+                        exon_end = exon_start + rnd.randint(50, 400)
+                        f.write('%s\tbench\texon\t%d\t%d\t.\t%s\t.\ttranscript_id "%s"; gene_id "%s";\n'
+                                % (contig, exon_start, exon_end, strand, tid, name))
+                        start = exon_end + rnd.randint(20, 300)
+                pos += rnd.randint(2500, 4000)
+    return path
+
+
+def make_bam(path, gtfpath, n_reads, seed=2):
+    """Sorted, indexed BAM of n_reads single-end 75 bp reads spread over the contigs of the GTF."""
+    import pysam
+    lengths = {}
+    with open(gtfpath) as f:
+        for line in f:
+            fields = line.split("\t")
+            lengths[fields[0]] = max(lengths.get(fields[0], 0), int(fields[4]) + 1000)
+    contigs = list(lengths)
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": contig, "LN": lengths[contig]} for contig in contigs]}
+    rnd = random.Random(seed)
+    positions = []
+    for _ in range(n_reads):
+        tid = rnd.randrange(len(contigs))
+        positions.append((tid, rnd.randint(0, lengths[contigs[tid]] - 400)))
+    positions.sort()
+    with pysam.AlignmentFile(path, "wb", header=header) as out:
+        for number, (tid, start) in enumerate(positions):
+            read = pysam.AlignedSegment()
+            read.query_name = "r%d" % number
+            read.reference_id = tid
+            read.reference_start = start
+            read.cigarstring = "30M200N45M" if number % 10 == 0 else "75M"
+            read.query_sequence = "A" * 75
+            read.flag = 16 if number % 2 else 0
+            read.mapping_quality = 60
+            out.write(read)
+    pysam.index(path)
+    return path
+
+
+def make_gff(path, n_genes, seed=3):
+    """GFF3 with n_genes genes (TAIR-style attributes: ID, Note, Name), each with an mRNA and an exon."""
+    rnd = random.Random(seed)
+    with open(path, "w") as f:
+        f.write("##gff-version 3\n")
+        per_contig = max(n_genes // len(CONTIGS), 1)
+        for number, contig in enumerate(CONTIGS, 1):
+            pos = 1
+            for i in range(per_contig):
+                pos += rnd.randint(-500, 3000)
+                pos = max(pos, 1)
+                length = rnd.randint(100, 8000)
+                name = "AT%dG%05d" % (number, i)
+                f.write("%s\tbench\tgene\t%d\t%d\t.\t%s\t.\tID=%s;Note=protein_coding_gene;Name=%s\n"
+                        % (contig, pos, pos + length, rnd.choice("+-"), name, name))
+                f.write("%s\tbench\tmRNA\t%d\t%d\t.\t+\t.\tID=%s.1;Parent=%s;Name=%s.1\n"
+                        % (contig, pos, pos + length, name, name, name))
+                f.write("%s\tbench\texon\t%d\t%d\t.\t+\t.\tParent=%s.1\n" % (contig, pos, pos + length // 2, name))
+    return path
+
+
+def make_regions(n_regions, span, seed=4):
+    """List of (chromosome, start, end) query regions over the synthetic GFF."""
+    rnd = random.Random(seed)
+    regions = []
+    for _ in range(n_regions):
+        start = rnd.randint(1, span)
+        regions.append((rnd.choice(CONTIGS), start, start + rnd.randint(1000, 50000)))
+    return regions
+
+
+def _blast_xml_header(first_query):
+    return ('<?xml version="1.0"?>\n'
+            '<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" '
+            '"http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">\n'
+            '<BlastOutput>\n'
+            '  <BlastOutput_program>blastp</BlastOutput_program>\n'
+            '  <BlastOutput_version>BLASTP 2.2.26+</BlastOutput_version>\n'
+            '  <BlastOutput_reference>synthetic</BlastOutput_reference>\n'
+            '  <BlastOutput_db>synthetic</BlastOutput_db>\n'
+            '  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>\n'
+            '  <BlastOutput_query-def>%s</BlastOutput_query-def>\n'
+            '  <BlastOutput_query-len>300</BlastOutput_query-len>\n'
+            '  <BlastOutput_param><Parameters><Parameters_matrix>BLOSUM62</Parameters_matrix>'
+            '<Parameters_expect>10</Parameters_expect><Parameters_gap-open>11</Parameters_gap-open>'
+            '<Parameters_gap-extend>1</Parameters_gap-extend><Parameters_filter>F</Parameters_filter>'
+            '</Parameters></BlastOutput_param>\n'
+            '  <BlastOutput_iterations>\n' % first_query)
+
+
+def make_blast(xmlpath, tabpath, queries, subjects, seed=5, hits_per_query=(1, 10)):
+    """BLAST XML (-outfmt 5) and matching tabular (-outfmt 6) output of queries against subjects.
+
+    Protein names are "<id> protein <id>"; with -parse_deflines style titles
+    (Hit_id is the ID), so XML titles equal the query definitions of the
+    reverse search. The hit with the same number as the query is made the
+    best hit most of the time, so there are plenty of reciprocal best hits."""
+    rnd = random.Random(seed)
+    sequence = "MKVLAG" * 50
+    with open(xmlpath, "w") as xml, open(tabpath, "w") as tab:
+        xml.write(_blast_xml_header(queries[0]))
+        for number, query in enumerate(queries):
+            xml.write("<Iteration>\n  <Iteration_iter-num>%d</Iteration_iter-num>\n"
+                      "  <Iteration_query-ID>Query_%d</Iteration_query-ID>\n"
+                      "  <Iteration_query-def>%s</Iteration_query-def>\n"
+                      "  <Iteration_query-len>300</Iteration_query-len>\n  <Iteration_hits>\n"
+                      % (number + 1, number + 1, query))
+            if rnd.random() < 0.85:
+                hits = rnd.sample(subjects, min(rnd.randint(*hits_per_query), len(subjects)))
+                if rnd.random() < 0.7 and number < len(subjects) and subjects[number] not in hits:
+                    hits[0] = subjects[number]
+                scores = sorted((rnd.uniform(30, 900) for _ in hits), reverse=True)
+                for rank, (subject, score) in enumerate(zip(hits, scores), 1):
+                    evalue = 10 ** (-score / 10)
+                    hit_id, hit_def = subject.split(" ", 1)
+                    xml.write("<Hit>\n  <Hit_num>%d</Hit_num>\n  <Hit_id>%s</Hit_id>\n  <Hit_def>%s</Hit_def>\n"
+                              "  <Hit_accession>%d</Hit_accession>\n  <Hit_len>300</Hit_len>\n  <Hit_hsps>\n"
+                              "    <Hsp>\n      <Hsp_num>1</Hsp_num>\n      <Hsp_bit-score>%.2f</Hsp_bit-score>\n"
+                              "      <Hsp_score>%d</Hsp_score>\n      <Hsp_evalue>%.3g</Hsp_evalue>\n"
+                              "      <Hsp_query-from>1</Hsp_query-from>\n      <Hsp_query-to>300</Hsp_query-to>\n"
+                              "      <Hsp_hit-from>1</Hsp_hit-from>\n      <Hsp_hit-to>300</Hsp_hit-to>\n"
+                              "      <Hsp_query-frame>0</Hsp_query-frame>\n      <Hsp_hit-frame>0</Hsp_hit-frame>\n"
+                              "      <Hsp_identity>150</Hsp_identity>\n      <Hsp_positive>200</Hsp_positive>\n"
+                              "      <Hsp_gaps>0</Hsp_gaps>\n      <Hsp_align-len>300</Hsp_align-len>\n"
+                              "      <Hsp_qseq>%s</Hsp_qseq>\n      <Hsp_hseq>%s</Hsp_hseq>\n"
+                              "      <Hsp_midline>%s</Hsp_midline>\n    </Hsp>\n  </Hit_hsps>\n</Hit>\n"
+                              % (rank, hit_id, hit_def, rank, score, int(score * 2), evalue,
+                                 sequence, sequence, sequence))
+                    tab.write("%s\t%s\t50.0\t300\t150\t0\t1\t300\t1\t300\t%.3g\t%.1f\n"
+                              % (query.split(" ", 1)[0], hit_id, evalue, score))
+            xml.write("</Iteration_hits>\n  <Iteration_stat><Statistics><Statistics_db-num>%d</Statistics_db-num>"
+                      "<Statistics_db-len>100000</Statistics_db-len><Statistics_hsp-len>0</Statistics_hsp-len>"
+                      "<Statistics_eff-space>0</Statistics_eff-space><Statistics_kappa>0.041</Statistics_kappa>"
+                      "<Statistics_lambda>0.267</Statistics_lambda><Statistics_entropy>0.14</Statistics_entropy>"
+                      "</Statistics></Iteration_stat>\n</Iteration>\n" % len(subjects))
+        xml.write("</BlastOutput_iterations>\n</BlastOutput>\n")
+    return xmlpath, tabpath
+
+
+def species_proteins(prefix, n):
+    """Protein names for one synthetic species."""
+    return ["%s%d protein %s%d" % (prefix, i, prefix, i) for i in range(n)]
+
+
+def make_fasta(path, n_records, length=(200, 3000), width=60, seed=6):
+    """FASTA of n_records random DNA sequences with a few N runs, wrapped at width bases."""
+    rnd = random.Random(seed)
+    with open(path, "w") as f:
+        for number in range(n_records):
+            bases = rnd.choices("ACGT", k=rnd.randint(*length))
+            if number % 50 == 0:
+                start = rnd.randrange(len(bases))
+                bases[start:start + 20] = "N" * len(bases[start:start + 20])
+            sequence = "".join(bases)
+            f.write(">seq%d synthetic record %d\n" % (number, number))
+            f.write("".join(sequence[i:i + width] + "\n" for i in range(0, len(sequence), width)))
+    return path
+
+
+ANNOTATION_WORDS = ("protein kinase receptor like transcription factor family zinc finger domain containing "
+                    "putative unknown function ribosomal subunit heat shock binding leucine rich repeat "
+                    "oxidoreductase transporter").split()
+
+
+def make_annotation_db(path, n_rows, seed=7):
+    """SQLite database with a geneannotation(gene, annotation) table of n_rows rows."""
+    import sqlite3
+    rnd = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE geneannotation (gene TEXT, annotation TEXT)")
+    con.executemany("INSERT INTO geneannotation VALUES (?, ?)",
+                    (("AT%dG%05d" % (rnd.randint(1, 5), i), " ".join(rnd.choices(ANNOTATION_WORDS, k=rnd.randint(2, 8))))
+                     for i in range(n_rows)))
+    con.commit()
+    con.close()
+    return path
+
+
+#####----BENCHMARKS-------------###############
+#Each benchmark takes the data folder and the size, makes what it needs (only once per
+#folder and size) and returns (function to time, number of items it handles).
+
+def _cached(workdir, name, make):
+    path = os.path.join(workdir, name)
+    if not os.path.exists(path):
+        make(path)
+    return path
+
+
+def _gtf_and_bam(workdir, size):
+    gtf = _cached(workdir, "genes_%d.gtf" % size, lambda p: make_gtf(p, size))
+    bam = _cached(workdir, "reads_%d.bam" % size, lambda p: make_bam(p, gtf, size * 20))
+    return gtf, bam
+
+
+def bench_sam_sweep(workdir, size):
+    from SAMParser import getTranscriptcounts
+    gtf, bam = _gtf_and_bam(workdir, size)
+    out = os.path.join(workdir, "counts.txt")
+    return (lambda: getTranscriptcounts(gtf, bam, out, method="sweep")), size * 20
+
+
+def bench_sam_count(workdir, size):
+    from SAMParser import getTranscriptcounts
+    gtf, bam = _gtf_and_bam(workdir, size)
+    out = os.path.join(workdir, "counts.txt")
+    return (lambda: getTranscriptcounts(gtf, bam, out, method="count")), size * 20
+
+
+def bench_sam_genes(workdir, size):
+    from SAMParser import getGeneCounts
+    gtf, bam = _gtf_and_bam(workdir, size)
+    out = os.path.join(workdir, "gene_counts.txt")
+    return (lambda: getGeneCounts(gtf, bam, out, stranded="yes", min_mapq=0)), size * 20
+
+
+def _blast_pair(workdir, size):
+    a, b = species_proteins("dm", size), species_proteins("ce", size)
+    names = [os.path.join(workdir, "%s_%d.%s" % (pair, size, ext))
+             for pair in ("dm_ce", "ce_dm") for ext in ("xml", "tsv")]
+    if not all(os.path.exists(name) for name in names):
+        make_blast(names[0], names[1], a, b, seed=5)
+        make_blast(names[2], names[3], b, a, seed=8)
+    return names
+
+
+def bench_blast_xml_biopython(workdir, size):
+    from homology import getBestHomolog
+    xml = _blast_pair(workdir, size)[0]
+    return (lambda: getBestHomolog(xml)), size
+
+
+def bench_blast_xml_streaming(workdir, size):
+    from homology import getBestHomologStreaming
+    xml = _blast_pair(workdir, size)[0]
+    return (lambda: getBestHomologStreaming(xml)), size
+
+
+def bench_blast_tabular(workdir, size):
+    from homology import getBestHomologTabular
+    tab = _blast_pair(workdir, size)[1]
+    return (lambda: getBestHomologTabular(tab)), size
+
+
+def bench_blast_tabular_bulk(workdir, size):
+    from homology import getBestHomologTabular
+    tab = _blast_pair(workdir, size)[1]
+    return (lambda: getBestHomologTabular(tab, bulk=True)), size
+
+
+def bench_rbh(workdir, size):
+    from homology import getReciprocalBestHomology
+    xml1, _, xml2, _ = _blast_pair(workdir, size)
+    out = os.path.join(workdir, "homologs.txt")
+
+    def run():
+        if os.path.exists(out):
+            os.remove(out)
+        getReciprocalBestHomology(xml1, xml2, out)
+    return run, 2 * size
+
+
+def _fasta(workdir, size):
+    return _cached(workdir, "seqs_%d.fasta" % size, lambda p: make_fasta(p, size))
+
+
+def bench_fasta_load(workdir, size):
+    from seq_tools import fasta_load
+    fasta = _fasta(workdir, size)
+    return (lambda: fasta_load(fasta)), size
+
+
+def bench_fasta_iter(workdir, size):
+    from seq_tools import fasta_iter
+    fasta = _fasta(workdir, size)
+
+    def run():
+        for record in fasta_iter(fasta):
+            pass
+    return run, size
+
+
+def bench_sequence_orfs(workdir, size):
+    from seq_tools import Sequence, fasta_iter
+    fasta = _fasta(workdir, size)
+
+    def run():
+        for header, sequence in fasta_iter(fasta):
+            s = Sequence(sequence)
+            s.get_long()
+            s.convert()
+    return run, size
+
+
+def bench_indexed_fetch(workdir, size):
+    from seq_tools import IndexedFasta
+    fasta = _fasta(workdir, size)
+    rnd = random.Random(9)
+    with IndexedFasta(fasta) as index:
+        queries = []
+        for _ in range(size):
+            name = "seq%d" % rnd.randrange(size)
+            start = rnd.randrange(index.length(name))
+            queries.append((name, start, start + 100))
+
+    def run():
+        with IndexedFasta(fasta) as index:
+            for name, start, end in queries:
+                index.fetch(name, start, end)
+    return run, size
+
+
+def _gff(workdir, size):
+    return _cached(workdir, "genes_%d.gff" % size, lambda p: make_gff(p, size))
+
+
+def _regions(size):
+    #Genes are about 1250 bp apart on average, so this covers each chromosome
+    return make_regions(max(size // 10, 10), size * 1250 // len(CONTIGS))
+
+
+def bench_gff_region_text(workdir, size):
+    from gffparser import gene_names_in_region
+    gff = _gff(workdir, size)
+    regions = _regions(size)[:10]
+
+    def run():
+        for chromosome, start, end in regions:
+            gene_names_in_region(gff, chromosome, start, end, cache=False)
+    return run, len(regions)
+
+
+def bench_gff_region_cached(workdir, size):
+    from gffparser import gene_names_in_region
+    gff = _gff(workdir, size)
+    regions = _regions(size)[:10]
+    gene_names_in_region(gff, *regions[0])
+    return (lambda: [gene_names_in_region(gff, *region) for region in regions]), len(regions)
+
+
+def bench_gff_region_index(workdir, size):
+    from gffparser import RegionIndex
+    gff = _gff(workdir, size)
+    regions = _regions(size)
+
+    def run():
+        index = RegionIndex.from_gff(gff)
+        for region in regions:
+            index.overlapping(*region)
+    return run, len(regions)
+
+
+def _database(workdir, size):
+    def make(path):
+        from gene_annotation_search import build_fts_index
+        make_annotation_db(path, size * 10)
+        build_fts_index(path)
+    return _cached(workdir, "annotation_%d.sqlite" % size, make)
+
+
+KEYWORDS = ("kinase", "zinc finger", "heat shock", "transporter", "leucine rich", "ribosomal")
+
+
+def bench_keyword_like(workdir, size):
+    from gene_annotation_search import keyword_search
+    database = _database(workdir, size)
+    return (lambda: [keyword_search(word, database) for word in KEYWORDS]), len(KEYWORDS)
+
+
+def bench_keyword_fts(workdir, size):
+    from gene_annotation_search import fts_search
+    database = _database(workdir, size)
+    return (lambda: [fts_search(word, database) for word in KEYWORDS]), len(KEYWORDS)
+
+
+def bench_keyword_batch(workdir, size):
+    from gene_annotation_search import batch_search
+    database = _database(workdir, size)
+
+    def run():
+        with open(os.devnull, "w") as out:
+            batch_search(KEYWORDS * 10, out, database, fts=True)
+    return run, 10 * len(KEYWORDS)
+
+
+#Name -> (group, benchmark, modules it needs)
+BENCHMARKS = {
+    "sam_sweep": ("sam", bench_sam_sweep, ("pysam", "pandas", "numpy")),
+    "sam_count": ("sam", bench_sam_count, ("pysam", "pandas", "numpy")),
+    "sam_genes": ("sam", bench_sam_genes, ("pysam", "pandas", "numpy")),
+    "blast_xml_biopython": ("blast", bench_blast_xml_biopython, ("Bio",)),
+    "blast_xml_streaming": ("blast", bench_blast_xml_streaming, ()),
+    "blast_tabular": ("blast", bench_blast_tabular, ()),
+    "blast_tabular_bulk": ("blast", bench_blast_tabular_bulk, ("pandas",)),
+    "rbh": ("blast", bench_rbh, ("Bio",)),
+    "fasta_load": ("fasta", bench_fasta_load, ()),
+    "fasta_iter": ("fasta", bench_fasta_iter, ()),
+    "sequence_orfs": ("fasta", bench_sequence_orfs, ()),
+    "indexed_fetch": ("fasta", bench_indexed_fetch, ()),
+    "gff_region_text": ("gff", bench_gff_region_text, ()),
+    "gff_region_cached": ("gff", bench_gff_region_cached, ("numpy",)),
+    "gff_region_index": ("gff", bench_gff_region_index, ("numpy",)),
+    "keyword_like": ("sqlite", bench_keyword_like, ("pandas",)),
+    "keyword_fts": ("sqlite", bench_keyword_fts, ("pandas",)),
+    "keyword_batch": ("sqlite", bench_keyword_batch, ()),
+}
+
+
+#####----RUNNING-------------###############
+
+def _run_one(name, workdir, size, repeat):
+    #Runs in a fresh process, so peak memory belongs to this benchmark only
+    import contextlib
+    import io
+    import resource
+    import statistics
+    import time
+    import tracemalloc
+
+    sys.path.insert(0, HERE)
+    os.environ["BIOUTILS_CACHE_DIR"] = os.path.join(workdir, "cache")
+    group, bench, needs = BENCHMARKS[name]
+
+    quiet = io.StringIO()
+    with contextlib.redirect_stdout(quiet):
+        run, items = bench(workdir, size)
+        #Untimed warm-up, so lazy imports and first-touch caches are not counted
+        run()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        #One extra, untimed run to measure Python allocations
+        tracemalloc.start()
+        run()
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    best = min(times)
+    return {
+        "benchmark": name,
+        "group": group,
+        "size": size,
+        "items": items,
+        "repeat": repeat,
+        "wall_seconds_min": best,
+        "wall_seconds_median": statistics.median(times),
+        "items_per_second": items / best if best > 0 else None,
+        "peak_python_bytes": traced_peak,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _missing(modules):
+    import importlib.util
+    return [module for module in modules if importlib.util.find_spec(module) is None]
+
+
+def _environment():
+    import platform
+    import subprocess
+    try:
+        commit = subprocess.run(["git", "-C", HERE, "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "commit": commit}
+
+
+def run_benchmarks(sizes, names, workdir, repeat=3):
+    """Run the named benchmarks at every size, each in its own process, and return the results."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for size in sizes:
+        for name in names:
+            missing = _missing(BENCHMARKS[name][2])
+            if missing:
+                print("%-22s size %-8d skipped (missing %s)" % (name, size, ", ".join(missing)), file=sys.stderr)
+                continue
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                result = pool.submit(_run_one, name, workdir, size, repeat).result()
+            results.append(result)
+            print("%-22s size %-8d %9.4f s  %12.1f items/s  peak %8.1f MB" % (
+                name, size, result["wall_seconds_min"], result["items_per_second"] or 0,
+                result["peak_rss_kb"] / 1024), file=sys.stderr)
+    return {"environment": _environment(), "results": results}
+
+
+def compare(current, previous):
+    """Print the change in best wall time for every benchmark and size found in both runs."""
+    before = {(r["benchmark"], r["size"]): r for r in previous["results"]}
+    print("%-22s %8s %12s %12s %8s" % ("benchmark", "size", "before (s)", "after (s)", "speedup"))
+    for result in current["results"]:
+        old = before.get((result["benchmark"], result["size"]))
+        if old is None:
+            continue
+        print("%-22s %8d %12.4f %12.4f %7.2fx" % (
+            result["benchmark"], result["size"], old["wall_seconds_min"], result["wall_seconds_min"],
+            old["wall_seconds_min"] / result["wall_seconds_min"] if result["wall_seconds_min"] else float("inf")))
+
+
+if __name__ == "__main__":
+    #To run only on command line:
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Benchmark the parsing and counting hot paths on synthetic data")
+    parser.add_argument("--sizes", help="Comma separated data sizes (genes / queries / records)", default="1000,10000")
+    parser.add_argument("--only", help="Comma separated benchmark names or groups (sam, blast, fasta, gff, sqlite)")
+    parser.add_argument("--repeat", help="Timed runs per benchmark (best and median are reported)", type=int, default=3)
+    parser.add_argument("--workdir", help="Folder for the synthetic data (kept between runs, so it is made only once)")
+    parser.add_argument("-o", "--output", help="Path of the JSON results (default: print to stdout)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--list", help="List the benchmarks and exit", action="store_true")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (group, bench, needs) in BENCHMARKS.items():
+            print("%-22s %-7s %s" % (name, group, ", ".join(needs)))
+        sys.exit(0)
+
+    names = list(BENCHMARKS)
+    if args.only:
+        wanted = set(args.only.split(","))
+        unknown = wanted - set(BENCHMARKS) - {group for group, bench, needs in BENCHMARKS.values()}
+        if unknown:
+            parser.error("unknown benchmark or group: %s" % ", ".join(sorted(unknown)))
+        names = [name for name in names if name in wanted or BENCHMARKS[name][0] in wanted]
+
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), "python-bio-utils-bench")
+    sizes = [int(size) for size in args.sizes.split(",")]
+    report = run_benchmarks(sizes, names, os.path.abspath(workdir), args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
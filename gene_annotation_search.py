@@ -12,28 +12,225 @@ as a formatted table using pandas.
 Usage:
     python gene_annotation_search.py -q kinase
 
+For large tables, build the FTS5 full-text index once and search through it:
+    python gene_annotation_search.py --build-index
+    python gene_annotation_search.py -q "protein kinase" --fts
+
+For thousands of keywords, use batch mode (one keyword per line, '-' for stdin);
+results are streamed as TSV or JSON lines, without pandas:
+    python gene_annotation_search.py -b keywords.txt --fts --format jsonl > hits.jsonl
+
+Or keep the database open in a small local server:
+    python gene_annotation_search.py --serve 8765
+    curl "http://127.0.0.1:8765/search?q=kinase&fts=1"
+
+Add --profile report.json (or set BIOUTILS_PROFILE) for a JSON report of the
+time spent in each search and the number of rows found (see profiling.py).
+
 Dependencies:
     - pandas
     - sqlite3
     - argparse
 """
 
-def keyword_search(word):
-    con = sqlite3.connect("arabidopsis.sqlite") #Creating a connection with the database
-    cursor = con.cursor() 
-    cursor.execute("""SELECT  * FROM geneannotation WHERE annotation like '%{word}%'""".format(word=word))
+#Stage timers and counters, switched on with --profile or BIOUTILS_PROFILE
+import profiling
+
+#SQL for the two kinds of search; the search text is always a bound parameter (the ?)
+LIKE_SQL = """SELECT  * FROM geneannotation WHERE annotation like ?"""
+FTS_SQL = """SELECT geneannotation.* FROM geneannotation_fts
+             JOIN geneannotation ON geneannotation.rowid = geneannotation_fts.rowid
+             WHERE geneannotation_fts MATCH ?
+             ORDER BY geneannotation.rowid"""
+
+
+def search_rows(con, word, fts=False, prefix=True):
+    """Run one search on an open connection and return the cursor, to be iterated row by row."""
+    if fts:
+        return con.execute(FTS_SQL, (fts_match_query(word, prefix),))
+    return con.execute(LIKE_SQL, ("%" + word + "%",))
+
+
+@profiling.timed("keyword_search")
+def keyword_search(word, database="arabidopsis.sqlite"):
+    import sqlite3
+    import pandas as pd
+    con = sqlite3.connect(database) #Creating a connection with the database
+    cursor = search_rows(con, word)
    #Select *: All columns,
    #From the table  with name  geneannotation table, 
    #Where column name is annotation, 
    # Need wild card search for string or name 
    #Using % - the stuff ahead or behind the string, I don't know, but find anything with it . Can have any string of zero or more characters before or after.
     #Like - not definitive, but may have something like the string with anything behind or in front of it.
-    #.format(word = word): Assign word in the {} statement
+    #The word is passed as a bound parameter (the ?), so quotes in it can not break the SQL.
     output = cursor.fetchall() 
+    con.close()
+    profiling.count("rows", len(output))
+    df = pd.DataFrame(data = output)
+    return(df)
+
+
+@profiling.timed("build_fts_index")
+def build_fts_index(database="arabidopsis.sqlite"):
+    """Create (or refresh) the FTS5 full-text index over geneannotation.annotation.
+
+    The index is an external-content FTS5 table, geneannotation_fts, that points
+    back at geneannotation rows by rowid, plus triggers that keep it in step when
+    rows are inserted, deleted or updated. It only needs to be built once."""
+    import sqlite3
+    con = sqlite3.connect(database)
+    with con:
+        con.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS geneannotation_fts
+                USING fts5(annotation, content='geneannotation', content_rowid='rowid');
+
+            CREATE TRIGGER IF NOT EXISTS geneannotation_fts_insert AFTER INSERT ON geneannotation BEGIN
+                INSERT INTO geneannotation_fts(rowid, annotation) VALUES (new.rowid, new.annotation);
+            END;
+            CREATE TRIGGER IF NOT EXISTS geneannotation_fts_delete AFTER DELETE ON geneannotation BEGIN
+                INSERT INTO geneannotation_fts(geneannotation_fts, rowid, annotation)
+                    VALUES ('delete', old.rowid, old.annotation);
+            END;
+            CREATE TRIGGER IF NOT EXISTS geneannotation_fts_update AFTER UPDATE ON geneannotation BEGIN
+                INSERT INTO geneannotation_fts(geneannotation_fts, rowid, annotation)
+                    VALUES ('delete', old.rowid, old.annotation);
+                INSERT INTO geneannotation_fts(rowid, annotation) VALUES (new.rowid, new.annotation);
+            END;
+
+            INSERT INTO geneannotation_fts(geneannotation_fts) VALUES ('rebuild');
+        """)
+    con.close()
+
+
+def fts_match_query(words, prefix=True):
+    """Turn user text into an FTS5 MATCH expression for a phrase search.
+
+    The words are quoted as one phrase (so punctuation and FTS5 operators in
+    them are taken literally), and with prefix=True the last word may be the
+    start of a longer word, e.g. "protein kin" matches "protein kinase"."""
+    phrase = '"' + words.replace('"', '""') + '"'
+    return phrase + "*" if prefix else phrase
+
+
+@profiling.timed("fts_search")
+def fts_search(word, database="arabidopsis.sqlite", prefix=True):
+    """Search annotations through the FTS5 index made by build_fts_index.
+
+    Unlike keyword_search, this matches whole words (or word starts, with
+    prefix=True) instead of any substring, and uses the index instead of
+    scanning the table. Returns the matching geneannotation rows as a DataFrame."""
+    import sqlite3
+    import pandas as pd
+    con = sqlite3.connect(database)
+    output = search_rows(con, word, fts=True, prefix=prefix).fetchall()
+    con.close()
+    profiling.count("rows", len(output))
     df = pd.DataFrame(data = output)
     return(df)
 
     
+def open_readonly(database="arabidopsis.sqlite"):
+    """Open the database read-only, tuned for many lookups on one long-lived connection.
+
+    The file is memory-mapped (mmap_size), a larger page cache is kept
+    (cache_size, 64 MB) and query_only stops anything from writing to it."""
+    import sqlite3
+    from pathlib import Path
+    #as_uri() escapes characters like ?, # and % in the path, so they are not read as URI syntax
+    con = sqlite3.connect(Path(database).resolve().as_uri() + "?mode=ro", uri=True)
+    con.execute("PRAGMA query_only = ON")
+    con.execute("PRAGMA mmap_size = 1073741824")
+    con.execute("PRAGMA cache_size = -65536")
+    return con
+
+
+def format_rows(word, cursor, fmt="tsv"):
+    """Yield one output line per result row: the query word and the row's columns.
+
+    fmt="tsv" gives tab separated lines, fmt="jsonl" one JSON object per line
+    with the query under "query" and the table's column names as keys."""
+    import json
+    if fmt == "jsonl":
+        columns = [description[0] for description in cursor.description]
+        for row in cursor:
+            record = {"query": word}
+            record.update(zip(columns, row))
+            yield json.dumps(record) + "\n"
+    elif fmt == "tsv":
+        for row in cursor:
+            yield "\t".join([word] + ["" if value is None else str(value).replace("\t", " ").replace("\n", " ")
+                                       for value in row]) + "\n"
+    else:
+        raise ValueError("fmt should be 'tsv' or 'jsonl', not %r" % (fmt,))
+
+
+@profiling.timed("batch_search")
+def batch_search(words, output, database="arabidopsis.sqlite", fts=False, prefix=True, fmt="tsv"):
+    """Search many keywords on one read-only connection and stream the results to output.
+
+    words is any iterable of keywords (e.g. an open file, or sys.stdin); blank
+    lines are skipped. Results are written as they are found, without pandas."""
+    con = open_readonly(database)
+    try:
+        for word in words:
+            word = word.strip()
+            if not word:
+                continue
+            lines = list(format_rows(word, search_rows(con, word, fts, prefix), fmt))
+            output.writelines(lines)
+            profiling.count("keywords")
+            profiling.count("rows", len(lines))
+    finally:
+        con.close()
+
+
+def serve(database="arabidopsis.sqlite", port=8765, host="127.0.0.1"):
+    """Answer searches over local HTTP, keeping one read-only connection open between requests.
+
+    GET /search?q=kinase&fts=1&prefix=0&format=tsv
+    returns the matching rows as JSON lines (default) or TSV."""
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    con = open_readonly(database)
+
+    class SearchHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            word = params.get("q", [""])[0]
+            fmt = params.get("format", ["jsonl"])[0]
+            if url.path != "/search" or not word or fmt not in ("tsv", "jsonl"):
+                self.send_error(400, "use /search?q=word[&fts=1][&prefix=0][&format=tsv|jsonl]")
+                return
+            fts = params.get("fts", ["0"])[0] == "1"
+            prefix = params.get("prefix", ["1"])[0] != "0"
+            with profiling.stage("serve_request"):
+                body = "".join(format_rows(word, search_rows(con, word, fts, prefix), fmt)).encode()
+            profiling.count("requests")
+            profiling.count("response_bytes", len(body))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson" if fmt == "jsonl" else "text/tab-separated-values")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            #Keeping the terminal quiet for every request
+            pass
+
+    server = HTTPServer((host, port), SearchHandler)
+    print("Serving gene annotation searches on http://%s:%d/search?q=..." % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        con.close()
+
+
 #To run only on command line:
 
 if __name__=="__main__": 
@@ -41,8 +238,6 @@ if __name__=="__main__":
 
     #Importing required modules
     import argparse #So that arguments can be parsed
-    import pandas as pd
-    import sqlite3
    
     #Using arg parser
     parser = argparse.ArgumentParser()
@@ -51,10 +246,47 @@ if __name__=="__main__":
     #https://docs.python.org/3/library/argparse.html - Found this to be useful for information on parsing arguements.
     
     #Adding parsers as suggested in the question
-    parser.add_argument("-q", "--query", help ="Please provide query argument", required = True, type = str) #flag is required so setting it to true.
+    #Query is required unless only the index is being built
+    parser.add_argument("-q", "--query", help ="Please provide query argument", type = str)
+    parser.add_argument("-d", "--database", help ="Path to the SQLite database", default = "arabidopsis.sqlite")
+    parser.add_argument("--build-index", help ="Build the FTS5 full-text index (needed once before --fts)",
+                        action = "store_true")
+    parser.add_argument("--fts", help ="Search through the full-text index (whole words and word starts)",
+                        action = "store_true")
+    parser.add_argument("--no-prefix", help ="With --fts, match the exact words only, not word starts",
+                        action = "store_true")
+    parser.add_argument("-b", "--batch", help ="File with one keyword per line ('-' for stdin); "
+                        "results are streamed on one connection instead of printed as a table")
+    parser.add_argument("--format", help ="Output format for --batch", choices = ["tsv", "jsonl"], default = "tsv")
+    parser.add_argument("--serve", help ="Answer searches over local HTTP on this port, keeping the database open",
+                        type = int, metavar = "PORT")
+    #--profile, --profile-cprofile and --profile-memory
+    profiling.add_arguments(parser)
     
     args = parser.parse_args()
+
+    if args.query is None and args.batch is None and args.serve is None and not args.build_index:
+        parser.error("one of -q/--query, -b/--batch, --serve or --build-index is required")
+
+    with profiling.session("gene_annotation_search", args):
+        if args.build_index:
+            build_fts_index(args.database)
+    
+        if args.batch is not None:
+            #Many keywords - streaming the results without pandas
+            import sys
+            if args.batch == "-":
+                batch_search(sys.stdin, sys.stdout, args.database, args.fts, not args.no_prefix, args.format)
+            else:
+                with open(args.batch) as words:
+                    batch_search(words, sys.stdout, args.database, args.fts, not args.no_prefix, args.format)
+
+        if args.serve is not None:
+            serve(args.database, args.serve)
     
-    #Calling the keyword_search function that was made up above, and running it with the query(that is user inputted).
-    print(keyword_search(args.query) )
-        
+        #Calling the search function that was made up above, and running it with the query(that is user inputted).
+        if args.query is not None:
+            if args.fts:
+                print(fts_search(args.query, args.database, prefix = not args.no_prefix))
+            else:
+                print(keyword_search(args.query, args.database))
@@ -10,19 +10,272 @@ It supports both command-line usage and output redirection to a file.
 
 Command-line arguments:
 -i / --filepath           : Path to input GFF file [Required]  
--c / --chromosomenumber   : Chromosome (e.g., Chr1, Chr2) [Required]  
--s / --startcoordinate    : Start coordinate [Required]  
--e / --endcoordinate      : End coordinate [Required]  
+-c / --chromosomenumber   : Chromosome (e.g., Chr1, Chr2) [Required without -b]  
+-s / --startcoordinate    : Start coordinate [Required without -b]  
+-e / --endcoordinate      : End coordinate [Required without -b]  
+-b / --bedfile            : BED file of many regions, all answered in one run
+--overlap                 : Report genes overlapping a region, not only genes fully inside it
 -o / --outputpath         : Optional path to save output
+--no-cache                : Read the GFF text instead of the cached index (see annotation_index.py)
+--profile [PATH]          : Write a JSON report of stage timings and counters (see profiling.py)
+
+With -b or --overlap, each output line is: chromosome, start, end, gene name
+(tab separated, 1-based coordinates).
+
+Records can be streamed one at a time, from plain or gzip/bgzip files:
+>>> from gffparser import read_gff
+>>> for record in read_gff("example.gff.gz", chromosome="Chr1", feature="gene"):
+...     print(record.start, record.end, record.attributes['Name'])
+
+The region queries can also be imported:
+>>> from gffparser import gene_names_in_region, RegionIndex
+>>> gene_names_in_region("example.gff", "Chr1", 10000, 50000)
+>>> index = RegionIndex.from_gff("example.gff")
+>>> index.contained("Chr1", 10000, 50000)
+>>> index.overlapping("Chr1", 10000, 50000)
 
 Example usage:
 python gffparser.py -i example.gff -c Chr1 -s 10000 -e 50000
+python gffparser.py -i example.gff -b regions.bed --overlap -o genes.txt
 """
 
 
+import gzip
+
+#Stage timers and counters, switched on with --profile or BIOUTILS_PROFILE
+import profiling
+
+
+def _open_gff(filepath):
+    #gzip and bgzip files both start with the gzip magic bytes; bgzip is just many gzip blocks
+    with open(filepath, 'rb') as probe:
+        magic = probe.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(filepath, 'rt')
+    return open(filepath, 'r')
+
+
+class GFFRecord:
+    """One feature line of a GFF file.
+
+    The attribute column is kept as the raw text and only split into a
+    dictionary when .attributes is first used."""
+
+    __slots__ = ('seqid', 'source', 'type', 'start', 'end', 'score', 'strand',
+                 'phase', 'attributes_text', '_attributes')
+
+    def __init__(self, seqid, source, type, start, end, score, strand, phase, attributes_text):
+        self.seqid = seqid
+        self.source = source
+        self.type = type
+        self.start = start
+        self.end = end
+        self.score = score
+        self.strand = strand
+        self.phase = phase
+        self.attributes_text = attributes_text
+        self._attributes = None
+
+    @property
+    def attributes(self):
+        """Attribute column as a dictionary, e.g. {'ID': 'AT1G01010', 'Name': 'AT1G01010'}."""
+        if self._attributes is None:
+            self._attributes = _parse_attributes(self.attributes_text)
+        return self._attributes
+
+    def __repr__(self):
+        return 'GFFRecord(%s:%d-%d %s)' % (self.seqid, self.start, self.end, self.type)
+
+
+def read_gff(filepath, chromosome=None, feature=None):
+    """Yield GFFRecord objects one line at a time from a GFF file (plain, gzip or bgzip).
+
+    Comment lines are skipped and reading stops at a ##FASTA section, so memory
+    use does not grow with the file. The chromosome and feature filters are
+    checked before the coordinates are converted or anything else is kept."""
+    with _open_gff(filepath) as file:
+        for line in file:
+            if line.startswith('#'):
+                if line.startswith('##FASTA'):
+                    break
+                continue
+            row = line.rstrip('\r\n').split('\t', 8)
+            if len(row) < 8:
+                continue
+            if chromosome is not None and row[0] != chromosome:
+                continue
+            if feature is not None and row[2] != feature:
+                continue
+            yield GFFRecord(row[0], row[1], row[2], int(row[3]), int(row[4]), row[5],
+                            row[6], row[7], row[8] if len(row) > 8 else '')
+
+
+@profiling.timed('gene_names_in_region')
+def gene_names_in_region(filepath, chromosome, start, end, cache=True):
+    """Return the names of genes on a chromosome that lie fully inside start..end.
+
+    With cache=True (default) the GFF file is read through the on-disk index in
+    annotation_index.py, so only the first call parses the text and later calls
+    memory-map it. With cache=False the file is streamed with read_gff every time."""
+
+    names = []
+
+    if cache:
+        from annotation_index import load_annotation_index
+        index = load_annotation_index(filepath)
+
+        #Chromosome, gene feature and coordinates are checked on the whole column at once
+        keep = index.mask(feature='gene', contig=chromosome)
+        keep &= (index.start >= start) & (index.end <= end)
+        for attributes in index.attributes(keep.nonzero()[0]):
+            names.append(_gene_name(attributes))
+        return names
+
+    #Chromosome and gene feature are checked by read_gff before the rest of the line is used
+    for record in read_gff(filepath, chromosome=chromosome, feature='gene'):
+        if record.start >= start: #Values greater and equal to the provided start
+            if record.end <= end: #Values lesser and equal to the provided stop
+                names.append(_gene_name(record.attributes_text))
+    return names
+
+
+def _gene_name(attributes):
+    #Third entry of the last column is Name=genename
+    return attributes.split(';')[2].split('=')[1]
+
+
+def _parse_attributes(text):
+    #key=value pairs of the attribute column; items without '=' are skipped
+    return dict(item.split('=', 1) for item in text.split(';') if '=' in item)
+
+
+def _feature_name(attributes):
+    #Name= of a parsed attribute column, or ID= when there is no name; None when it has neither
+    return attributes.get('Name') or attributes.get('ID')
+
+
+class RegionIndex:
+    """Per-chromosome interval index over GFF features for many region queries.
+
+    Features of each chromosome are kept sorted by start, with an implicit
+    binary tree laid over the sorted array where every node also stores the
+    largest end in its subtree (max-end augmentation). Containment and overlap
+    queries take O(log n + k) time for k results. Coordinates are 1-based and
+    inclusive at both ends, as in the GFF file."""
+
+    def __init__(self, features):
+        """features: iterable of (chromosome, start, end, name) tuples."""
+        by_chromosome = {}
+        for order, (chromosome, start, end, name) in enumerate(features):
+            by_chromosome.setdefault(chromosome, []).append((start, order, end, name))
+
+        self.chromosomes = {}
+        for chromosome, rows in by_chromosome.items():
+            rows.sort()
+            starts = [row[0] for row in rows]
+            ends = [row[2] for row in rows]
+            names = [row[3] for row in rows]
+            maxends, depth = self._augment(ends)
+            self.chromosomes[chromosome] = (starts, ends, names, maxends, depth)
+
+    @classmethod
+    @profiling.timed('RegionIndex.from_gff')
+    def from_gff(cls, filepath, feature='gene', cache=True):
+        """Build the index for one feature type of a GFF file, named by the Name= attribute
+        (or ID= when there is no name). Features with neither are left out."""
+        if cache:
+            from annotation_index import load_annotation_index
+            index = load_annotation_index(filepath)
+            rows = index.select(feature=feature)
+            features = zip(index.contig_names(rows), index.start[rows].tolist(), index.end[rows].tolist(),
+                           (_feature_name(_parse_attributes(text)) for text in index.attributes(rows)))
+        else:
+            features = ((record.seqid, record.start, record.end, _feature_name(record.attributes))
+                        for record in read_gff(filepath, feature=feature))
+
+        return cls(feature for feature in features if feature[3] is not None)
+
+    @staticmethod
+    def _augment(ends):
+        #Node i of the implicit tree sits at level = number of trailing 1 bits of i;
+        #its children are i - 2**(level-1) and i + 2**(level-1). Leaves (even i) keep their own end.
+        n = len(ends)
+        maxends = list(ends)
+        if n == 0:
+            return maxends, 0
+        last_i = (n - 1) & ~1
+        last = maxends[last_i]
+        k = 1
+        while 1 << k <= n:
+            x = 1 << (k - 1)
+            for i in range((x << 1) - 1, n, x << 2):
+                right = maxends[i + x] if i + x < n else last
+                maxends[i] = max(ends[i], maxends[i - x], right)
+            last_i = last_i - x if last_i >> k & 1 else last_i + x
+            if last_i < n and maxends[last_i] > last:
+                last = maxends[last_i]
+            k += 1
+        return maxends, k - 1
+
+    def overlapping(self, chromosome, start, end):
+        """Return names of features that share at least one base with start..end."""
+        if chromosome not in self.chromosomes:
+            return []
+        starts, ends, names, maxends, depth = self.chromosomes[chromosome]
+        n = len(starts)
+        hits = []
+        #Stack of (level, node, left child done)
+        stack = [(depth, (1 << depth) - 1, False)]
+        while stack:
+            level, node, left_done = stack.pop()
+            if level <= 3:
+                #Small subtree - a linear scan is quicker than walking it
+                i0 = node >> level << level
+                i1 = min(i0 + (1 << (level + 1)) - 1, n)
+                for i in range(i0, i1):
+                    if starts[i] > end:
+                        break
+                    if ends[i] >= start:
+                        hits.append(i)
+            elif not left_done:
+                stack.append((level, node, True))
+                left = node - (1 << (level - 1))
+                #Left subtree only if it is past the end of the array or may reach the query
+                if left >= n or maxends[left] >= start:
+                    stack.append((level - 1, left, False))
+            elif node < n and starts[node] <= end:
+                if ends[node] >= start:
+                    hits.append(node)
+                stack.append((level - 1, node + (1 << (level - 1)), False))
+        hits.sort()
+        return [names[i] for i in hits]
+
+    def contained(self, chromosome, start, end):
+        """Return names of features that lie fully inside start..end."""
+        from bisect import bisect_left, bisect_right
+        if chromosome not in self.chromosomes:
+            return []
+        starts, ends, names, maxends, depth = self.chromosomes[chromosome]
+        #Only features starting inside the region can be contained in it
+        first = bisect_left(starts, start)
+        last = bisect_right(starts, end)
+        return [names[i] for i in range(first, last) if ends[i] <= end]
+
+
+def read_bed_regions(filepath):
+    """Yield (chromosome, start, end) from a BED file, converted to 1-based inclusive coordinates."""
+    with open(filepath, 'r') as file:
+        for line in file:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            row = line.rstrip().split('\t')
+            yield row[0], int(row[1]) + 1, int(row[2])
+
+
 if __name__=="__main__": 
     #To run only on command line:
     import argparse #So that arguments can be parsed
+    import sys
        
     parser = argparse.ArgumentParser() #Saving the argparse.ArgumentParser with a variable name so it can be used below. 
 
@@ -33,78 +286,81 @@ if __name__=="__main__":
     parser.add_argument("-i", "--filepath", help ="Please provide path to file",
                        required = True)
     
+    #Chromosome, start and end are required unless the regions come from a BED file (-b)
     parser.add_argument("-c", "--chromosomenumber", 
-                        help ="Please provide chromosome number, eg. Chr1, Chr2, etc", 
-                        required = True)
+                        help ="Please provide chromosome number, eg. Chr1, Chr2, etc")
     
     parser.add_argument("-s", "--startcoordinate",
                        help ="Please provide start coordinate of region", 
-                       type = int, required = True)    
+                       type = int)    
     
     parser.add_argument("-e", "--endcoordinate", 
                         help ="Please provide end coordinate of region", 
-                        type = int, required = True)
+                        type = int)
+
+    parser.add_argument("-b", "--bedfile", 
+                        help ="BED file of regions to query all at once, instead of -c/-s/-e")
+
+    parser.add_argument("--overlap", 
+                        help ="Report genes overlapping the region instead of genes fully inside it", 
+                        action = 'store_true')
     
     parser.add_argument("-o", "--outputpath", 
                         help ="Please provide path where the output should be stored", 
                        # action = 'store',
                         required = False) #Setting required to be false, because if is provided then the output will be saved, if not I want to only print the output.
 
+    parser.add_argument("--no-cache", 
+                        help ="Read the GFF text every time instead of the cached index", 
+                        action = 'store_true')
+
+    #--profile, --profile-cprofile and --profile-memory
+    profiling.add_arguments(parser)
+
     args = parser.parse_args()
-    
-    #Making empty variables, so that it can be populated later.
-    enteries =[]
-    nameofenteries =[]
-    finaloutput=[]
-   
-
-    import re
-    with open(args.filepath, 'r') as file:
-        
-        reader1 = file.readlines()
-        reader = []
-        
-        for line in reader1:
-           
-           #print(line.split('\t'))
-            reader2 = line.rstrip().split('\t') 
-            reader.append(reader2)
-        #print(reader)   
-            
-        for row in reader:
-                if row[0] == args.chromosomenumber: 
-                    #print(row) #Column 0 - is chromosome number
-                    if row[2] == 'gene': #Column 2 - is gene. Setting this as a set feature with gene. 
-                        if int(row[3]) >= args.startcoordinate: #Values greater and equal to the provided start
-                            if int(row[4]) <= args.endcoordinate:#Values lesser and equal to the provided stop
-                                #print(row)
-                                enteries =row[8].split(';') #Now the last column has names and other info. Split by ;
-                            
-                            #The third column of that has only name, split that by =, that is name=genename. Need only something.
-                                nameofenteries = enteries[2].split('=') 
-    
-                            #Getting the genename, which is the first column.
-                                finaloutput = (nameofenteries[1]) #Save that finaloutput variable name.
-
-                                if args.outputpath: #if argsoutput path is set, then it is telling to do this/
-                                    my_output = args.outputpath #Storing outputpath as a variable name
-                                
-                             #opening the file/filepath, a is for append. So it will append, write "w" was overwriting values. 
-                                    f = open(my_output, "a") 
-                                    f.write(finaloutput)#So within the file now adding the finaloutput value
-                                    f.write("\n") #So that every output is on a new line.
-                                    f.close() #Close the file
-                            
-                                else:    #If no outputpath arguement given
-                        
-                                    print(finaloutput) #Then just print the finaloutput.
-                            
-                
-
-                        
-            
-                
-                
-        
-    
-    
+
+    if args.bedfile is None and None in (args.chromosomenumber, args.startcoordinate, args.endcoordinate):
+        parser.error("-c, -s and -e are required unless -b/--bedfile is given")
+
+    with profiling.session("gffparser", args):
+        #Opening the output once - a is for append, so it will append, write "w" was overwriting values.
+        #If no outputpath arguement given, the output goes to the screen.
+        output = open(args.outputpath, "a") if args.outputpath else sys.stdout
+
+        if args.bedfile is None and not args.overlap:
+            #One region: getting the gene names through the cached index unless --no-cache is given
+            names = gene_names_in_region(args.filepath, args.chromosomenumber,
+                                         args.startcoordinate, args.endcoordinate,
+                                         cache=not args.no_cache)
+            output.write("".join(name + "\n" for name in names)) #So that every output is on a new line.
+            profiling.count("genes_reported", len(names))
+        else:
+            #Many regions (or overlap queries): building the interval index once and asking it for every region
+            index = RegionIndex.from_gff(args.filepath, cache=not args.no_cache)
+            query = index.overlapping if args.overlap else index.contained
+
+            if args.bedfile is None:
+                regions = [(args.chromosomenumber, args.startcoordinate, args.endcoordinate)]
+            else:
+                regions = read_bed_regions(args.bedfile)
+
+            #Every line is the region (chromosome, start, end) and one gene name, separated by tabs;
+            #lines are collected and written in blocks instead of one write per gene
+            lines = []
+            found = nregions = 0
+            with profiling.stage("query_regions"):
+                for chromosome, start, end in regions:
+                    nregions += 1
+                    for name in query(chromosome, start, end):
+                        lines.append("%s\t%d\t%d\t%s\n" % (chromosome, start, end, name))
+                    if len(lines) >= 10000:
+                        found += len(lines)
+                        output.write("".join(lines))
+                        lines = []
+                found += len(lines)
+                output.write("".join(lines))
+            profiling.count("regions", nregions)
+            profiling.count("genes_reported", found)
+
+        if output is not sys.stdout:
+            output.close() #Close the file
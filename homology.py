@@ -4,16 +4,28 @@
 # Created: 2023
 #
 # Description:
-# This script defines two functions:
+# This script defines these functions:
 # - getBestHomolog(xmlfilepath): extracts best homologs for each query sequence
+# - getBestHomologStreaming(xmlfilepath): same result as getBestHomolog, faster and with bounded memory
+# - getBestHomologTabular(tabfilepath): same, from BLAST/DIAMOND tabular (-outfmt 6/7) output
+# - getReciprocalBestHits(besthits1, besthits2): joins two best-hit dictionaries into RBH pairs
 # - getReciprocalBestHomology(xml1, xml2, output): finds reciprocal best hits (RBHs)
+# - getAllReciprocalBestHomology(species, filepattern): RBHs for every pair of species in a panel,
+#   reading each Blast output once and in parallel
 #
 # Usage:
 # Import these functions in another script or run as a standalone module
 # with appropriate XML BLAST outputs from two species.
+# Setting BIOUTILS_PROFILE=report.json (see profiling.py) writes the time spent
+# parsing each Blast output, joining the best hits and writing the output.
 ################################################################################
 
+#Stage timers and counters, switched on with BIOUTILS_PROFILE
+import profiling
+
+
 #Making function to obtain best homolog.
+@profiling.timed("getBestHomolog")
 def getBestHomolog(xmlfilepath1):
     """This function reads an the output of Blast search (Xml file)
     and returns the best Homolog for each protein, if it exists.
@@ -47,72 +59,281 @@ def getBestHomolog(xmlfilepath1):
             my_dict[QueryID]= TargetID
             
     
+    profiling.count_file("xml_bytes", xmlfilepath1)
+    profiling.count("proteins_with_hits", len(my_dict))
     
     #Returning the dictionary outside the loop.
     return(my_dict)
 
 
+@profiling.timed("getBestHomologStreaming")
+def getBestHomologStreaming(xmlfilepath1, chunksize = 1 << 22):
+    """This function reads the output of Blast search (Xml file, -outfmt 5) and returns the best
+    Homolog for each protein, if it exists - the same dictionary as getBestHomolog.
+    The file is read in blocks. For each <Iteration> (one per protein) only the part up to the
+    end of the first <Hit> is handed to the Xml parser; the rest of the record, with all its
+    other hits and HSPs, is skipped without being parsed and dropped from memory.
+    So memory use stays the same however large the file is.
+    
+    Input required: Path to blast output as an Xml file.
+    chunksize: how many bytes to read at a time. """
+    
+    from xml.etree.ElementTree import fromstring
+
+    #Creating empty dictionary so it can be populated in the for loop below
+    my_dict = {}
+
+    #Older Blast versions only give the query definition once, at the top of the file
+    header_query = None
+
+    buffer = b""
+    searched = 0
+    with open(xmlfilepath1, "rb") as f:
+        while True:
+            block = f.read(chunksize)
+            buffer += block
+
+            if header_query is None:
+                first = buffer.find(b"<Iteration>")
+                if first < 0 and block:
+                    continue
+                header_query = _xmlElementText(buffer[:first], b"BlastOutput_query-def")
+
+            #Going over every record that is complete in the buffer
+            position = 0
+            while True:
+                #Tags can not appear inside Xml text, so finding them in the raw bytes is safe
+                end = buffer.find(b"</Iteration>", max(position, searched))
+                if end < 0:
+                    break
+                begin = buffer.find(b"<Iteration>", position, end)
+                firsthit = buffer.find(b"</Hit>", begin, end)
+                if firsthit < 0:
+                    #No hits for this protein, so nothing to keep
+                    position = end + len(b"</Iteration>")
+                    continue
+
+                #Parsing only the start of the record and its first hit, closing the tags that were cut off
+                record = fromstring(buffer[begin:firsthit + len(b"</Hit>")] + b"</Iteration_hits></Iteration>")
+                hit = record.find("Iteration_hits/Hit")
+
+                #Get TargetID title (Hit_id and Hit_def, like Biopython's alignment title) and QueryID
+                TargetID = (hit.findtext("Hit_id") or "") + " " + (hit.findtext("Hit_def") or "")
+                QueryID = record.findtext("Iteration_query-def") or header_query
+
+                #Saving it as a dictionary with QueryID as key and TargetID as values.
+                my_dict[QueryID] = TargetID
+                position = end + len(b"</Iteration>")
+
+            #Keeping only the unfinished record for the next block
+            buffer = buffer[position:]
+            searched = max(len(buffer) - len(b"</Iteration>"), 0)
+            if not block:
+                break
+
+    profiling.count_file("xml_bytes", xmlfilepath1)
+    profiling.count("proteins_with_hits", len(my_dict))
+
+    #Returning the dictionary outside the loop.
+    return(my_dict)
+
+
+def _xmlElementText(data, tag):
+    #Text of the first <tag>...</tag> element in a piece of Xml, or "" if there is none
+    from xml.etree.ElementTree import fromstring
+    start = data.find(b"<" + tag + b">")
+    if start < 0:
+        return ""
+    end = data.find(b"</" + tag + b">", start)
+    return fromstring(data[start:end + len(tag) + 3]).text or ""
+
+
+#Column names of the default BLAST/DIAMOND tabular output (-outfmt 6 / 7)
+TABULAR_COLUMNS = ("qseqid", "sseqid", "pident", "length", "mismatch", "gapopen",
+                   "qstart", "qend", "sstart", "send", "evalue", "bitscore")
+
+
+@profiling.timed("getBestHomologTabular")
+def getBestHomologTabular(tabfilepath, bulk = False, columns = TABULAR_COLUMNS):
+    """This function reads BLAST or DIAMOND tabular output (-outfmt 6, or 7 with # comment lines)
+    and returns the best Homolog for each protein, like getBestHomolog does for Xml files.
+    The best hit is the one with the highest bitscore, then the lowest evalue,
+    then the first one in the file - which is the hit BLAST lists first in the Xml output.
+    Proteins are named by their sequence IDs (qseqid and sseqid), i.e. the first word of the
+    Xml query and hit titles.
+    
+    Input required: Path to blast output as a tabular file.
+    bulk: if True, the whole table is loaded with pandas and reduced in one go (faster, uses more memory);
+    default is to stream the file line by line, keeping only the current best hit per protein.
+    columns: column names in the file, if a custom -outfmt 6 was used; it needs qseqid, sseqid, evalue and bitscore. """
+    
+    columns = list(columns)
+    qi, si, ei, bi = (columns.index(name) for name in ("qseqid", "sseqid", "evalue", "bitscore"))
+
+    if bulk:
+        import pandas as pd
+        try:
+            df = pd.read_csv(tabfilepath, sep = "\t", header = None, comment = "#",
+                             usecols = [qi, si, ei, bi], dtype = {qi: str, si: str, ei: float, bi: float})
+        except pd.errors.EmptyDataError:
+            #No hits at all (e.g. -outfmt 7 with only # lines) - same empty result as streaming
+            profiling.count_file("tabular_bytes", tabfilepath)
+            return {}
+        df.columns = [columns[i] for i in sorted((qi, si, ei, bi))]
+        #Stable sort keeps file order between equal hits, then the first row per protein is its best hit
+        best = (df.sort_values(["bitscore", "evalue"], ascending = [False, True], kind = "stable")
+                  .drop_duplicates("qseqid")
+                  .set_index("qseqid")["sseqid"])
+        #Putting proteins back in the order they first appear in the file
+        best = best.reindex(pd.unique(df["qseqid"]))
+        profiling.count_file("tabular_bytes", tabfilepath)
+        profiling.count("hits", len(df))
+        profiling.count("proteins_with_hits", len(best))
+        return dict(zip(best.index, best.to_numpy()))
+
+    #Dictionary of QueryID -> (TargetID, bitscore, evalue) for the best hit seen so far
+    my_dict = {}
+    hits = 0
+    with open(tabfilepath) as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            hits += 1
+            fields = line.rstrip("\r\n").split("\t")
+            QueryID = fields[qi]
+            bitscore = float(fields[bi])
+            evalue = float(fields[ei])
+            current = my_dict.get(QueryID)
+            if (current is None or bitscore > current[1]
+                    or (bitscore == current[1] and evalue < current[2])):
+                my_dict[QueryID] = (fields[si], bitscore, evalue)
+
+    profiling.count_file("tabular_bytes", tabfilepath)
+    profiling.count("hits", hits)
+    profiling.count("proteins_with_hits", len(my_dict))
+
+    #Keeping only TargetID as the value, same as getBestHomolog
+    return {QueryID: best[0] for QueryID, best in my_dict.items()}
+
+
+def getReciprocalBestHits(besthits1, besthits2):
+    """This function finds reciprocal best hits from two best-homolog dictionaries,
+    like the ones returned by getBestHomolog.
+    A pair is kept when the best hit of a protein in species 1 has that same protein
+    as its own best hit in species 2.
+    
+    Input required:
+    besthits1: dictionary of QueryID -> TargetID for Species 1 searched against Species 2
+    besthits2: dictionary of QueryID -> TargetID for Species 2 searched against Species 1
+    Returns a list of (Species 1 protein, Species 2 protein) pairs, in the order of besthits1. """
+    
+    #Looking up each target of Species 1 directly in the Species 2 dictionary
+    #This is one dictionary lookup per protein, instead of comparing every pair of keys.
+    return [(query, target) for query, target in besthits1.items()
+            if besthits2.get(target) == query]
+
+
+@profiling.timed("getReciprocalBestHomology")
 def getReciprocalBestHomology(xmlfilepath1, xmlfilepath2, outputpath = "homologs.txt"):
     
     """This function gives proteins with the best reciprocal homology in the two species.
     Input required: 
     xmlfilepath1: Path to blast output as an Xml file for Species 1.
     xmlfilepath2: Path to blast output as an Xml file for Species 2.
-    outputpath = default is homologs.txt
+    outputpath = default is homologs.txt - pairs are appended to it, one per line, tab separated.
+    Returns the list of (Species 1 protein, Species 2 protein) pairs.
     
     """
-    #Importing modules
-    from Bio.Blast import NCBIXML
-    import pandas as pd
-
 
     #Using the earlier function getBestHomolog to obtain best homolog for each species
     print("Obtaining best identified homolog for each protein for Species 1 ...")
-    output_of_Drosophila = getBestHomolog("drosophila_celegans.xml")
+    output_of_Species1 = getBestHomolog(xmlfilepath1)
     print("Best homolog for each protein (if it exists) in Species 1 has been identified! ")  
     print("...............................................................................")
     
     print("Obtaining best identified homolog for each protein for Species 2 ...")
-    output_of_Celegans = getBestHomolog("celegans_drosophila.xml")
+    output_of_Species2 = getBestHomolog(xmlfilepath2)
     print("Best homolog for each protein (if it exists) in Species 2 has been identified! ")  
     print("...............................................................................")
     
     #Find reciprocal best homology between the two species:
     print("Obtaining reciprocal best homology between Species 1 and 2...")
+    with profiling.stage("getReciprocalBestHits"):
+        pairs = getReciprocalBestHits(output_of_Species1, output_of_Species2)
+    profiling.count("reciprocal_pairs", len(pairs))
+    
+    #Opening the output file once and appending every reciprocal best homology in one write,
+    #each pair separated by a tab and on a new line.
+    with profiling.stage("write_output"), open(outputpath, "a") as f:
+        f.write("".join("%s\t%s\n" % pair for pair in pairs))
     
-    #Making a for loop that first iterates over every key and value in output_of_Drosophila dictionary made earlier
-    for eachkey_Drosophilia, eachvalue_Drosophilia in output_of_Drosophila.items():
-        
-        #Making a second for loop that first iterates over every key and value in output_of_Celegans dictionary made earlier
-        #So basically eachkey_Drosophilia and eachvalue_Drosophilia will be checked with all keys and values in C.elegans dictionary.
-        for eachkey_Celegans, eachvalue_Celegans in output_of_Celegans.items():
-            
-            #For matching reciprocal homology
-            #searching if key of Drosophilia (which was the Query ID) - matches values in C.elgans(TargetID)
-            if eachkey_Drosophilia == eachvalue_Celegans:
-                
-                #And also nesting the otherway 
-                #if key of C.elegans (which was the Query ID) - matches values in Drosophilia(TargetID)
-                if eachkey_Celegans == eachvalue_Drosophilia:
-                    
-                    #If it does: Then asking it to open and append values to outputfile - whatever user defined/default
-                    f = open(outputpath, "a") 
-                    
-                    #Append eachkey_Drosophilia
-                    f.write(eachkey_Drosophilia)
-                    
-                    #Adding a tab to separate
-                    f.write("\t")
-                    
-                    #Append eachkey_Drosophilia
-                    f.write(eachvalue_Drosophilia)
-                    
-                    #So that every reciprocal best homology is on a new line.
-                    f.write("\n") 
-                    
-                     #Close the file
-                    f.close()
     print("Reciprocal best homology between Species 1 and 2 has been obtained, and can be found in the output file! ")
+    return pairs
+
+
+#Functions used to read one Blast output, by file format
+_BEST_HIT_READERS = {"xml": getBestHomologStreaming, "tabular": getBestHomologTabular}
+
+
+def _readBestHits(task):
+    #One task is one directional Blast output: (query species, subject species, path, file format)
+    query, subject, path, fileformat = task
+    return query, subject, _BEST_HIT_READERS[fileformat](path)
+
+
+@profiling.timed("getAllReciprocalBestHomology")
+def getAllReciprocalBestHomology(species, filepattern, outputpath = "orthologs.txt",
+                                 fileformat = "xml", processes = None):
+    """This function gives proteins with the best reciprocal homology for every pair of species in a panel.
+    Each directional Blast output is read only once, in a pool of processes, and its best hits are
+    kept in memory for every pair that needs them - N*(N-1) files are read for N species,
+    instead of twice that when calling getReciprocalBestHomology for each pair.
+    
+    Input required:
+    species: list of species names, e.g. ["drosophila", "celegans", "yeast"]
+    filepattern: path of the Blast output of one species searched against another, with {query}
+    and {subject} in place of the species names, e.g. "blast/{query}_{subject}.xml"
+    outputpath = default is orthologs.txt - one tab separated table for all pairs, with the columns
+    species1, protein1, species2, protein2 (species1 comes before species2 in the species list).
+    fileformat: "xml" (read with getBestHomologStreaming) or "tabular" (read with getBestHomologTabular)
+    processes: number of worker processes, default is the number of cores
+    Returns the rows of the table as a list of tuples. """
+    
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import combinations, permutations
+
+    if fileformat not in _BEST_HIT_READERS:
+        raise ValueError("fileformat should be 'xml' or 'tabular', not %r" % (fileformat,))
+
+    species = list(species)
+    tasks = [(query, subject, filepattern.format(query = query, subject = subject), fileformat)
+             for query, subject in permutations(species, 2)]
+
+    #Reading every directional Blast output once, in parallel
+    print("Obtaining best identified homolog for each protein from %d Blast outputs ..." % len(tasks))
+    besthits = {}
+    with profiling.stage("read_best_hits_pool"), ProcessPoolExecutor(max_workers = processes) as pool:
+        for query, subject, hits in pool.map(_readBestHits, tasks):
+            besthits[query, subject] = hits
+    for task in tasks:
+        profiling.count_file("blast_bytes", task[2])
+    print("Best homolog for each protein (if it exists) has been identified for every species pair! ")
+    print("...............................................................................")
+
+    #Joining the two directions of each pair - one dictionary lookup per protein, so this is quick
+    #next to reading the files and is done here rather than sending the dictionaries back to the pool.
+    print("Obtaining reciprocal best homology for every species pair...")
+    rows = []
+    with profiling.stage("getReciprocalBestHits"):
+        for species1, species2 in combinations(species, 2):
+            for protein1, protein2 in getReciprocalBestHits(besthits[species1, species2], besthits[species2, species1]):
+                rows.append((species1, protein1, species2, protein2))
+    profiling.count("reciprocal_pairs", len(rows))
 
+    #Writing the consolidated table in one pass
+    with profiling.stage("write_output"), open(outputpath, "w") as f:
+        f.write("species1\tprotein1\tspecies2\tprotein2\n")
+        f.write("".join("%s\t%s\t%s\t%s\n" % row for row in rows))
 
-                                   
\ No newline at end of file
+    print("Reciprocal best homology for all species pairs has been obtained, and can be found in the output file! ")
+    return rows
@@ -0,0 +1,279 @@
+"""
+profiling.py — Stage Timers, Counters and Profiling Reports for the Tools
+
+Description:
+This module is the shared instrumentation used by SAMParser.py, homology.py,
+gffparser.py, gene_annotation_search.py, seq_tools.py and annotation_index.py.
+The tools mark their main steps as stages (GTF parsing, BAM counting, XML
+parsing, output writing, ...) and add up counters (records, reads, bytes).
+With profiling switched on, a JSON report is written at the end with:
+
+- the wall and CPU time of every stage (nested stages are named "outer/inner")
+- the counters
+- total wall and CPU time, and the peak resident memory of the process
+- optionally, the top functions from cProfile and the top allocation sites
+  from tracemalloc
+
+Profiling is off by default and then costs one check per marked stage.
+
+Switching it on:
+    python gffparser.py -i genes.gff -b regions.bed --profile report.json
+    python seq_tools.py -i tx.fasta -o prot.fasta --profile - --profile-cprofile
+    BIOUTILS_PROFILE=report.json python my_pipeline.py      (any script using the tools)
+
+--profile with no path, or BIOUTILS_PROFILE=-, writes the report to stderr.
+BIOUTILS_PROFILE_CPROFILE=1 and BIOUTILS_PROFILE_MEMORY=1 add the cProfile
+and tracemalloc sections, like --profile-cprofile and --profile-memory.
+
+Marking stages in code:
+>>> import profiling
+>>> @profiling.timed("load_gtf")
+... def load(path): ...
+>>> with profiling.stage("write_output"):
+...     write(rows)
+>>> profiling.count("reads", nreads)
+
+Work done inside worker processes is timed as a whole by the stage around
+the pool in the main process.
+"""
+
+import atexit
+import functools
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+PROFILE_ENV = "BIOUTILS_PROFILE"
+PROFILE_CPROFILE_ENV = "BIOUTILS_PROFILE_CPROFILE"
+PROFILE_MEMORY_ENV = "BIOUTILS_PROFILE_MEMORY"
+
+#How many functions / allocation sites to keep in the report
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 20
+
+
+class Profiler:
+    """Collects stage times and counters for one run, and makes the report."""
+
+    def __init__(self, tool=None, output=None, cprofile=False, memory=False):
+        script = sys.argv[0] if sys.argv and sys.argv[0] not in ("", "-", "-c") else "python"
+        self.tool = tool or os.path.basename(script)
+        self.output = output
+        self.stages = {}
+        self.counters = {}
+        self.pid = os.getpid()
+        self._stack = []
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+        self._cprofile = None
+        if cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+        self._memory = False
+        if memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._memory = True
+
+    @contextmanager
+    def stage(self, name):
+        self._stack.append(name)
+        key = "/".join(self._stack)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            totals = self.stages.get(key)
+            if totals is None:
+                totals = self.stages[key] = {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+            totals["calls"] += 1
+            totals["wall_seconds"] += time.perf_counter() - wall
+            totals["cpu_seconds"] += time.process_time() - cpu
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """Return the report as a dictionary (ready for json.dump)."""
+        import resource
+        report = {
+            "tool": self.tool,
+            "argv": sys.argv,
+            "pid": self.pid,
+            "wall_seconds": time.perf_counter() - self._wall,
+            "cpu_seconds": time.process_time() - self._cpu,
+            #ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == "darwin" else 1),
+            "stages": self.stages,
+            "counters": self.counters,
+        }
+        if self._cprofile is not None:
+            report["cprofile"] = self._cprofile_top()
+        if self._memory:
+            report["tracemalloc"] = self._tracemalloc_top()
+        return report
+
+    def _cprofile_top(self):
+        import pstats
+        self._cprofile.disable()
+        stats = pstats.Stats(self._cprofile).stats
+        rows = []
+        for (filename, line, function), (primitive, calls, total, cumulative, callers) in stats.items():
+            rows.append({"function": "%s:%d(%s)" % (filename, line, function), "calls": calls,
+                         "primitive_calls": primitive, "total_seconds": total, "cumulative_seconds": cumulative})
+        rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+        return rows[:TOP_FUNCTIONS]
+
+    def _tracemalloc_top(self):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATIONS]
+        return {"current_bytes": current, "peak_bytes": peak,
+                "top": [{"where": str(stat.traceback[0]), "size_bytes": stat.size, "count": stat.count}
+                        for stat in top]}
+
+    def write(self, report=None):
+        """Write the report to self.output (a path, or '-' for stderr)."""
+        import json
+        text = json.dumps(report or self.report(), indent=2) + "\n"
+        if self.output in (None, "-"):
+            sys.stderr.write(text)
+        else:
+            with open(self.output, "w") as f:
+                f.write(text)
+
+
+#The profiler of this run, or None when profiling is off
+_active = None
+
+
+def active():
+    """Return the running Profiler, or None."""
+    return _active
+
+
+def start(tool=None, output=None, cprofile=False, memory=False):
+    """Switch profiling on. The report is written by stop(), or when the program exits."""
+    global _active
+    if _active is None:
+        _active = Profiler(tool, output, cprofile, memory)
+        atexit.register(_write_at_exit)
+    return _active
+
+
+def stop():
+    """Switch profiling off, write the report and return it as a dictionary."""
+    global _active
+    profiler, _active = _active, None
+    if profiler is None:
+        return None
+    report = profiler.report()
+    profiler.write(report)
+    return report
+
+
+def _write_at_exit():
+    #Only the process that started profiling writes the report, not worker processes that inherited it
+    if _active is not None and _active.pid == os.getpid():
+        stop()
+
+
+class _NoStage:
+    #Used for stages while profiling is off - does nothing, and one instance serves every stage
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    """Context manager timing the code inside it as the stage name (nothing happens when profiling is off)."""
+    if _active is None:
+        return _NO_STAGE
+    return _active.stage(name)
+
+
+def timed(name):
+    """Decorator timing every call of a function as the stage name."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            with _active.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    """Add n to the counter name."""
+    if _active is not None:
+        _active.count(name, n)
+
+
+def count_file(name, path):
+    """Add the size of a file, in bytes, to the counter name."""
+    if _active is not None:
+        try:
+            _active.count(name, os.path.getsize(path))
+        except (OSError, TypeError):
+            pass
+
+
+def add_arguments(parser):
+    """Add --profile, --profile-cprofile and --profile-memory to an argparse parser."""
+    parser.add_argument("--profile", nargs="?", const="-", metavar="PATH",
+                        help="Write a JSON report of stage timings and counters to PATH (stderr if no PATH is given)")
+    parser.add_argument("--profile-cprofile", action="store_true",
+                        help="With --profile, add the top functions from cProfile to the report")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="With --profile, add the top allocation sites from tracemalloc to the report")
+
+
+@contextmanager
+def session(tool, args=None):
+    """Profile the code inside it if the command line (see add_arguments) or BIOUTILS_PROFILE asks for it.
+
+    The report is written when the block ends, also after an error or Ctrl-C."""
+    output = getattr(args, "profile", None)
+    if output is None and _active is None:
+        yield None
+        return
+    profiler = _active
+    if profiler is None:
+        profiler = start(tool, output, getattr(args, "profile_cprofile", False), getattr(args, "profile_memory", False))
+    else:
+        #Already switched on by the environment variable - the command line still names the tool and the output
+        profiler.tool = tool
+        if output is not None:
+            profiler.output = output
+    try:
+        yield profiler
+    finally:
+        stop()
+
+
+def _start_from_environment():
+    #Checked on every import of every tool, so nothing more is imported unless profiling is asked for
+    if not os.environ.get(PROFILE_ENV):
+        return
+    #Worker processes of a pool are left alone, so there is one report per run
+    import multiprocessing
+    if multiprocessing.parent_process() is None:
+        start(output=os.environ[PROFILE_ENV],
+              cprofile=os.environ.get(PROFILE_CPROFILE_ENV, "") not in ("", "0"),
+              memory=os.environ.get(PROFILE_MEMORY_ENV, "") not in ("", "0"))
+
+
+_start_from_environment()
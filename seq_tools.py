@@ -7,7 +7,19 @@ Date: May 2023
 Description:
 This module includes:
 - fasta_load: Loads sequences from a FASTA file
+- fasta_iter: Streams (header, sequence) pairs from a FASTA file (plain or gzip)
+- build_fai / IndexedFasta: faidx-compatible index and random access to sequences and regions
+- find_orfs: Six-frame ORF coordinates in linear time
+- reverse_complement / translate: Fast reverse complement (bytes.translate) and translation
+  with any NCBI genetic code (numpy codon lookup when numpy is installed)
 - Sequence class: For reverse complement, longest ORF detection, and protein translation
+- PackedSequence class: Same methods on a 2-bit packed copy, for holding many sequences
+- orf_batch: Longest ORF and protein of every record of a FASTA file, in a process pool
+
+Command line (longest ORFs of a whole FASTA file, using every core):
+    python seq_tools.py -i transcripts.fasta -o proteins.fasta -t orfs.tsv
+Add --profile report.json for a JSON report of the time spent reading, waiting
+for the workers and writing (see profiling.py).
 
 
 Usage:
@@ -17,75 +29,628 @@ Usage:
 >>> s.get_long()
 >>> s.convert()
 >>> print(s.get_orf())
+>>> for header, seq in fasta_iter("transcripts.fasta.gz"):
+...     orf = Sequence(seq).get_long()
+>>> genome = IndexedFasta("genome.fasta")
+>>> genome.fetch("Chr1", 1000, 1100)
 """
 
 import re
+from collections.abc import Mapping
+from types import MappingProxyType
 
-def fasta_load(filename):
-    """Load sequences from a FASTA file."""
-    sequences = []
-    seq = ''
-    with open(filename, 'r') as f:
+#Stage timers and counters, switched on with --profile or BIOUTILS_PROFILE
+import profiling
+
+def _open_text(filename):
+    #gzip (and bgzip) files start with the gzip magic bytes
+    import gzip
+    with open(filename, 'rb') as probe:
+        magic = probe.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(filename, 'rt')
+    return open(filename, 'r')
+
+
+def fasta_iter(filename):
+    """Yield (header, sequence) pairs from a FASTA file, one record at a time.
+
+    The header is the text after '>' without the line end (None for sequence
+    lines that come before the first header). The file may be
+    plain or gzip compressed. Each sequence is built with a single join of its
+    lines, so only one record is held in memory at a time."""
+    header = None
+    lines = []
+    with _open_text(filename) as f:
         for line in f:
             line = line.strip()
             if line.startswith('>'):
-                if seq:
-                    sequences.append(seq)
-                    seq = ''
-            else:
-                seq += line
-        if seq:
-            sequences.append(seq)
-    return sequences
+                if header is not None or lines:
+                    yield header, ''.join(lines)
+                header = line[1:]
+                lines = []
+            elif line:
+                lines.append(line)
+        if header is not None or lines:
+            yield header, ''.join(lines)
+
+
+@profiling.timed('fasta_load')
+def fasta_load(filename):
+    """Load sequences from a FASTA file."""
+    seqs = [seq for header, seq in fasta_iter(filename) if seq]
+    profiling.count_file('fasta_bytes', filename)
+    profiling.count('records', len(seqs))
+    return seqs
+
+
+@profiling.timed('build_fai')
+def build_fai(filename):
+    """Write a samtools-compatible .fai index next to a FASTA file and return its path.
+
+    Each line of the index is: name, sequence length, byte offset of the first
+    base, bases per line and bytes per line (tab separated). Every line of a
+    record except the last must have the same length, as samtools requires."""
+    entries = []
+    with open(filename, 'rb') as f:
+        offset = 0
+        name = None
+        for line in f:
+            linelength = len(line)
+            if line.startswith(b'>'):
+                if name is not None:
+                    entries.append((name, length, seqoffset, linebases, linewidth))
+                name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ''
+                seqoffset = offset + linelength
+                length = linebases = linewidth = 0
+                short_line_seen = False
+            elif name is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if bases:
+                    if short_line_seen:
+                        raise ValueError("%s: lines of sequence %r have different lengths" % (filename, name))
+                    if linebases == 0:
+                        linebases, linewidth = bases, linelength
+                    elif bases != linebases or linelength != linewidth:
+                        if bases > linebases:
+                            raise ValueError("%s: lines of sequence %r have different lengths" % (filename, name))
+                        short_line_seen = True
+                    length += bases
+                elif linebases:
+                    short_line_seen = True
+            offset += linelength
+        if name is not None:
+            entries.append((name, length, seqoffset, linebases, linewidth))
+
+    #Empty sequences are left out, the same as samtools does
+    entries = [entry for entry in entries if entry[1] > 0]
+
+    fai = filename + '.fai'
+    with open(fai, 'w') as out:
+        out.write(''.join('%s\t%d\t%d\t%d\t%d\n' % entry for entry in entries))
+    return fai
+
+
+class IndexedFasta:
+    """Random access to sequences of a FASTA file through a .fai index.
+
+    The index is read from filename.fai (as written by build_fai or
+    `samtools faidx`), and built first if it is missing or older than the
+    FASTA file. The FASTA file is memory-mapped, so only the bytes of the
+    requested region are read.
+
+    >>> fasta = IndexedFasta("genome.fasta")
+    >>> fasta.fetch("Chr1", 1000, 1100)   # 0-based, end excluded, like slicing
+    >>> fasta["ChrM"]                      # whole sequence
+    """
+
+    def __init__(self, filename):
+        import mmap
+        import os
+        self.filename = filename
+        fai = filename + '.fai'
+        if not os.path.exists(fai) or os.path.getmtime(fai) < os.path.getmtime(filename):
+            build_fai(filename)
+        self.index = {}
+        with open(fai) as f:
+            for line in f:
+                name, length, offset, linebases, linewidth = line.rstrip('\n').split('\t')[:5]
+                self.index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+        self._file = open(filename, 'rb')
+        if os.path.getsize(filename):
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._data = b''
+
+    @property
+    def names(self):
+        """Sequence names, in file order."""
+        return list(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return self.fetch(name)
+
+    def length(self, name):
+        """Number of bases in a sequence."""
+        return self.index[name][0]
+
+    def fetch(self, name, start=None, end=None):
+        """Return bases start..end (0-based, end excluded) of a sequence as a string.
+
+        start and end default to the whole sequence and are clipped to its length."""
+        length, offset, linebases, linewidth = self.index[name]
+        start = 0 if start is None else max(start, 0)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return ''
+        first = offset + start // linebases * linewidth + start % linebases
+        last = offset + (end - 1) // linebases * linewidth + (end - 1) % linebases + 1
+        return self._data[first:last].replace(b'\n', b'').replace(b'\r', b'').decode()
+
+    def close(self):
+        if not isinstance(self._data, bytes):
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+STOP_CODONS = ('TAA', 'TAG', 'TGA')
+
+#Complement of each base; other characters (N, etc.) stay as they are
+_COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+_COMPLEMENT_BYTES = bytes.maketrans(b'ACGT', b'TGCA')
+
+#NCBI genetic codes: amino acid for each codon, codons ordered TTT, TTC, TTA, TTG, TCT, ... GGG
+#(bases in the order T, C, A, G as NCBI lists them), '*' for stop.
+#Tables whose stop codons depend on context (27, 28, 31) are left out.
+NCBI_GENETIC_CODES = {
+    1: 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',   #Standard
+    2: 'FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSS**VVVVAAAADDEEGGGG',   #Vertebrate Mitochondrial
+    3: 'FFLLSSSSYY**CCWWTTTTPPPPHHQQRRRRIIMMTTTTNNKKSSRRVVVVAAAADDEEGGGG',   #Yeast Mitochondrial
+    4: 'FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',   #Mold, Protozoan, Coelenterate Mitochondrial
+    5: 'FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSSSSVVVVAAAADDEEGGGG',   #Invertebrate Mitochondrial
+    6: 'FFLLSSSSYYQQCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',   #Ciliate Nuclear
+    9: 'FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNNKSSSSVVVVAAAADDEEGGGG',   #Echinoderm Mitochondrial
+    10: 'FFLLSSSSYY**CCCWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Euplotid Nuclear
+    11: 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Bacterial, Archaeal and Plant Plastid
+    12: 'FFLLSSSSYY**CC*WLLLSPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Alternative Yeast Nuclear
+    13: 'FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSSGGVVVVAAAADDEEGGGG',  #Ascidian Mitochondrial
+    14: 'FFLLSSSSYYY*CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNNKSSSSVVVVAAAADDEEGGGG',  #Alternative Flatworm Mitochondrial
+    15: 'FFLLSSSSYY*QCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Blepharisma Macronuclear
+    16: 'FFLLSSSSYY*LCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Chlorophycean Mitochondrial
+    21: 'FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNNKSSSSVVVVAAAADDEEGGGG',  #Trematode Mitochondrial
+    22: 'FFLLSS*SYY*LCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Scenedesmus obliquus Mitochondrial
+    23: 'FF*LSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Thraustochytrium Mitochondrial
+    24: 'FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSSKVVVVAAAADDEEGGGG',  #Rhabdopleuridae Mitochondrial
+    25: 'FFLLSSSSYY**CCGWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Candidate Division SR1 and Gracilibacteria
+    26: 'FFLLSSSSYY**CC*WLLLAPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Pachysolen tannophilus Nuclear
+    29: 'FFLLSSSSYYYYCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Mesodinium Nuclear
+    30: 'FFLLSSSSYYEECC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Peritrich Nuclear
+    32: 'FFLLSSSSYY*WCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG',  #Balanophoraceae Plastid
+    33: 'FFLLSSSSYYY*CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSSKVVVVAAAADDEEGGGG',  #Cephalodiscidae Mitochondrial
+}
+
+
+def reverse_complement(sequence):
+    """Return the reverse complement of an (uppercase) DNA sequence; other characters are kept."""
+    try:
+        return sequence.encode('ascii').translate(_COMPLEMENT_BYTES)[::-1].decode('ascii')
+    except UnicodeEncodeError:
+        return sequence.translate(_COMPLEMENT)[::-1]
+
+
+def codon_table(table=1, stop='_'):
+    """Return a genetic code as a dictionary of codon -> amino acid ('_' for stop by default).
+
+    table is an NCBI translation table number, e.g. 1 (standard), 2 (vertebrate mitochondrial)."""
+    if table not in NCBI_GENETIC_CODES:
+        raise ValueError("unknown NCBI translation table %r" % (table,))
+    amino_acids = NCBI_GENETIC_CODES[table].replace('*', stop)
+    codons = [a + b + c for a in 'TCAG' for b in 'TCAG' for c in 'TCAG']
+    return dict(zip(codons, amino_acids))
+
+
+#Standard genetic code ('_' for stop), shared module-wide - read-only, so no caller can change it for everyone else
+GENETIC_CODE = MappingProxyType(codon_table(1))
+
+
+#Lookup arrays for translate, made once per (table, stop, unknown), or once per codon dictionary contents
+_TRANSLATION_LOOKUPS = {}
+
+
+def _codon_dict(table, stop):
+    #table is an NCBI table number or already a codon -> amino acid mapping;
+    #the standard code with '_' for stop is the shared GENETIC_CODE
+    if isinstance(table, Mapping):
+        return table
+    if table == 1 and stop == '_':
+        return GENETIC_CODE
+    return codon_table(table, stop)
+
+
+def _translation_lookup(table, stop, unknown):
+    import numpy as np
+    if table is GENETIC_CODE:
+        #The shared code is read-only, so it has the same lookup as table 1
+        table, stop = 1, '_'
+    if isinstance(table, Mapping):
+        #Other codon dictionaries are keyed by their contents: one that is changed gets a new lookup,
+        #and dictionaries with the same codons share one entry
+        key = (tuple(sorted(table.items())), unknown)
+    else:
+        key = (table, stop, unknown)
+    cached = _TRANSLATION_LOOKUPS.get(key)
+    if cached is None:
+        #Base numbers: A=0, C=1, G=2, T=3 (either case), anything else 4
+        base_number = bytearray(b'\x04' * 256)
+        for number, bases in enumerate((b'Aa', b'Cc', b'Gg', b'Tt')):
+            for base in bases:
+                base_number[base] = number
+        #Codon number = 25 * first + 5 * second + third, so a codon with any other base still has
+        #its own slot (0-124), and those slots hold the unknown amino acid
+        code = _codon_dict(table, stop)
+        amino_acids = bytearray(unknown.encode('ascii') * 125)
+        for i, a in enumerate('ACGT'):
+            for j, b in enumerate('ACGT'):
+                for k, c in enumerate('ACGT'):
+                    amino_acids[25 * i + 5 * j + k] = ord(code.get(a + b + c, unknown))
+        cached = _TRANSLATION_LOOKUPS[key] = (bytes(base_number), np.frombuffer(bytes(amino_acids), dtype=np.uint8))
+    return cached
+
+
+def translate(sequence, table=1, stop='_', unknown='X'):
+    """Translate a DNA sequence codon by codon into protein.
+
+    table is an NCBI translation table number, or a codon -> amino acid
+    mapping such as GENETIC_CODE (then stop is not used). Its lookup is
+    made on first use and reused for the same table or the same codons.
+    Every full codon is translated from the start of the sequence; codons with
+    a base other than A, C, G or T become unknown ('X'). With numpy installed
+    bases are numbered with bytes.translate, read as a uint8 array, every codon turned into a number and
+    all of them looked up in one table at once; without numpy it falls back to
+    a dictionary lookup per codon."""
+    try:
+        import numpy as np
+    except ImportError:
+        sequence = sequence.upper()
+        code = _codon_dict(table, stop)
+        return ''.join(code.get(sequence[i:i + 3], unknown) for i in range(0, len(sequence) - 2, 3))
+
+    base_number, amino_acids = _translation_lookup(table, stop, unknown)
+    raw = sequence.encode('ascii', 'replace')
+    usable = len(raw) // 3 * 3
+    bases = np.frombuffer(raw[:usable].translate(base_number), dtype=np.uint8).reshape(-1, 3)
+    codons = bases[:, 0] * 25 + bases[:, 1] * 5 + bases[:, 2]
+    return amino_acids[codons].tobytes().decode('ascii')
+
+
+def _codon_positions(strand, codons):
+    #Positions of every occurrence of the codons (overlapping ones too), split by reading frame
+    alternatives = '|'.join(re.escape(codon) for codon in codons)
+    #A plain search skips matches that overlap the previous one; that can only happen
+    #if the end of one codon is the start of another (never for the stop codons)
+    overlapping = any(a[k:] == b[:len(b) - k] for a in codons for b in codons for k in (1, 2))
+    pattern = re.compile('(?=(?:%s))' % alternatives if overlapping else alternatives)
+    positions = [match.start() for match in pattern.finditer(strand)]
+    return tuple([position for position in positions if position % 3 == frame] for frame in range(3))
+
+
+def find_orfs(sequence, min_length=0, starts=('ATG',), nested=False):
+    """Find ORFs in all six reading frames in one pass per strand.
+
+    An ORF runs from a start codon to the next in-frame stop codon, stop codon
+    included. Stop codons are indexed per frame, and each start codon finds its
+    stop with a binary search in that index. Without nested, only the first
+    start codon after the previous in-frame stop gives an ORF (the longest one
+    ending at that stop); with nested=True every start codon gives its own.
+    Work is linear in the sequence length.
+
+    min_length: smallest ORF to report, in bases (stop codon included)
+    starts: start codons to use, e.g. ('ATG', 'GTG', 'TTG') for alternative starts
+    Returns a list of (frame, strand, start, end) tuples. start and end are
+    0-based, end excluded, on the given (forward) sequence for both strands;
+    frame is 0-2, counted from the start of the strand the ORF is read on.
+    Forward-strand ORFs come first, then reverse-strand ones, each in the order
+    they are read on their strand."""
+    from bisect import bisect_right
+    sequence = sequence.upper()
+    n = len(sequence)
+    orfs = []
+    for strand, bases in (('+', sequence), ('-', reverse_complement(sequence))):
+        stops = _codon_positions(bases, STOP_CODONS)
+        start_codons = _codon_positions(bases, starts)
+        found = []
+        for frame in range(3):
+            frame_stops = stops[frame]
+            k = 0
+            orf_end = -1
+            for begin in start_codons[frame]:
+                #A start codon inside the ORF already found only makes a nested, shorter ORF
+                if begin < orf_end and not nested:
+                    continue
+                k = bisect_right(frame_stops, begin, k)
+                if k == len(frame_stops):
+                    break
+                orf_end = frame_stops[k] + 3
+                if orf_end - begin >= min_length:
+                    found.append((begin, frame, orf_end))
+        found.sort()
+        if strand == '+':
+            orfs.extend((frame, strand, begin, end) for begin, frame, end in found)
+        else:
+            orfs.extend((frame, strand, n - end, n - begin) for begin, frame, end in found)
+    return orfs
 
 
 class Sequence:
     """DNA sequence utility class for ORF finding and translation."""
 
+    #Codon -> amino acid used by convert, shared (read-only) by every instance instead of a copy per sequence;
+    #set another dictionary on an instance to use a different code, e.g. dict(GENETIC_CODE, TGA='W')
+    genetic_code = GENETIC_CODE
+
     def __init__(self, sequence):
         self.sequence = sequence.upper()
         self.converted = None
-        self.genetic_code = {
-            'ATA':'I', 'ATC':'I', 'ATT':'I', 'ATG':'M',
-            'ACA':'T', 'ACC':'T', 'ACG':'T', 'ACT':'T',
-            'AAC':'N', 'AAT':'N', 'AAA':'K', 'AAG':'K',
-            'AGC':'S', 'AGT':'S', 'AGA':'R', 'AGG':'R',
-            'CTA':'L', 'CTC':'L', 'CTG':'L', 'CTT':'L',
-            'CCA':'P', 'CCC':'P', 'CCG':'P', 'CCT':'P',
-            'CAC':'H', 'CAT':'H', 'CAA':'Q', 'CAG':'Q',
-            'CGA':'R', 'CGC':'R', 'CGG':'R', 'CGT':'R',
-            'GTA':'V', 'GTC':'V', 'GTG':'V', 'GTT':'V',
-            'GCA':'A', 'GCC':'A', 'GCG':'A', 'GCT':'A',
-            'GAC':'D', 'GAT':'D', 'GAA':'E', 'GAG':'E',
-            'GGA':'G', 'GGC':'G', 'GGG':'G', 'GGT':'G',
-            'TCA':'S', 'TCC':'S', 'TCG':'S', 'TCT':'S',
-            'TTC':'F', 'TTT':'F', 'TTA':'L', 'TTG':'L',
-            'TAC':'Y', 'TAT':'Y', 'TAA':'_', 'TAG':'_',
-            'TGC':'C', 'TGT':'C', 'TGA':'_', 'TGG':'W'
-        }
 
     def reverse(self):
         """Return the reverse complement of the sequence."""
-        complement = {'A':'T', 'T':'A', 'C':'G', 'G':'C'}
-        reverse_complement = ''.join(complement.get(base, base) for base in reversed(self.sequence))
-        return reverse_complement
-
-    def get_long(self):
-        """Find the longest ORF on both strands."""
-        pattern = re.compile(r'ATG(?:...)*?(?:TAA|TAG|TGA)')
-        strands = [self.sequence, self.reverse()]
-        orfs = [match.group() for strand in strands for match in pattern.finditer(strand)]
-        self.longest_orf = max(orfs, key=len, default='')
+        return reverse_complement(self.sequence)
+
+    def find_orfs(self, min_length=0, starts=('ATG',), nested=False):
+        """Return ORF coordinates on both strands, see find_orfs."""
+        return find_orfs(self.sequence, min_length, starts, nested)
+
+    def orf_sequence(self, orf):
+        """Return the bases of an ORF given as (frame, strand, start, end), read on its own strand."""
+        frame, strand, start, end = orf
+        bases = self.sequence[start:end]
+        return bases if strand == '+' else reverse_complement(bases)
+
+    def get_long(self, min_length=0, starts=('ATG',)):
+        """Find the longest ORF on both strands.
+
+        Its coordinates are kept in self.longest_orf_coords as (frame, strand, start, end)."""
+        orfs = self.find_orfs(min_length, starts)
+        self.longest_orf_coords = max(orfs, key=lambda orf: orf[3] - orf[2], default=None)
+        self.longest_orf = self.orf_sequence(self.longest_orf_coords) if self.longest_orf_coords else ''
         return self.longest_orf
 
-    def convert(self):
-        """Translate the longest ORF into a protein sequence."""
+    def convert(self, table=None):
+        """Translate the longest ORF into a protein sequence.
+
+        table is the NCBI translation table to use; by default the codon
+        dictionary in self.genetic_code (the standard code) is used."""
         if not hasattr(self, 'longest_orf'):
             self.get_long()
-        codons = [self.longest_orf[i:i+3] for i in range(0, len(self.longest_orf)-2, 3)]
-        self.converted = ''.join(self.genetic_code.get(codon, 'X') for codon in codons)
+        self.converted = translate(self.longest_orf, self.genetic_code if table is None else table)
         return self.converted
 
     def get_orf(self):
         """Return translated ORF (protein sequence)."""
         return self.converted if self.converted else ''
+
+
+#2-bit codes used by PackedSequence: A=0, C=1, G=2, T=3, anything else 4 (kept in the mask)
+_PACK_CODES = bytes(bytearray({ord('A'): 0, ord('C'): 1, ord('G'): 2, ord('T'): 3}.get(i, 4) for i in range(256)))
+
+
+class PackedSequence:
+    """Compact DNA sequence for holding very many sequences at once.
+
+    Bases are stored 2 bits each (4 per byte). Anything that is not A, C, G
+    or T (N, ambiguity codes) is kept in a sparse mask of (position, bases)
+    runs, so it comes back unchanged. Instances use __slots__ and share the
+    module-level codon table, so a sequence costs about a quarter of a plain
+    string. reverse, get_long, convert and get_orf work as in Sequence; only
+    the longest ORF's coordinates are kept, not a copy of its bases.
+    Needs numpy."""
+
+    __slots__ = ('_packed', '_length', '_mask', 'longest_orf_coords', 'converted')
+
+    #Same shared codon table as Sequence, used by convert
+    genetic_code = GENETIC_CODE
+
+    def __init__(self, sequence):
+        import numpy as np
+        raw = sequence.upper().encode('ascii')
+        self._length = len(raw)
+        codes = np.frombuffer(raw.translate(_PACK_CODES), dtype=np.uint8)
+
+        #Runs of other characters go in the mask as (start, original bases)
+        other = np.flatnonzero(codes > 3)
+        mask = []
+        if len(other):
+            breaks = np.flatnonzero(np.diff(other) != 1) + 1
+            for run in np.split(other, breaks):
+                mask.append((int(run[0]), raw[run[0]:run[-1] + 1]))
+        self._mask = tuple(mask)
+
+        #Packing 4 bases per byte, first base in the highest 2 bits
+        padded = np.zeros((self._length + 3) // 4 * 4, dtype=np.uint8)
+        padded[:self._length] = np.where(codes > 3, 0, codes)
+        quads = padded.reshape(-1, 4)
+        self._packed = (quads[:, 0] << 6 | quads[:, 1] << 4 | quads[:, 2] << 2 | quads[:, 3]).tobytes()
+        self.longest_orf_coords = None
+        self.converted = None
+
+    def __len__(self):
+        return self._length
+
+    def fetch(self, start=0, end=None):
+        """Return bases start..end (0-based, end excluded) as a string, unpacking only that part."""
+        import numpy as np
+        end = self._length if end is None else min(end, self._length)
+        start = max(start, 0)
+        if start >= end:
+            return ''
+        first = start // 4
+        packed = np.frombuffer(self._packed, dtype=np.uint8)[first:(end + 3) // 4]
+        codes = np.stack([packed >> 6, packed >> 4 & 3, packed >> 2 & 3, packed & 3], axis=1).ravel()
+        bases = np.frombuffer(b'ACGT', dtype=np.uint8)[codes[start - first * 4:end - first * 4]]
+        for position, run in self._mask:
+            if position < end and position + len(run) > start:
+                lo = max(position, start)
+                hi = min(position + len(run), end)
+                bases[lo - start:hi - start] = np.frombuffer(run[lo - position:hi - position], dtype=np.uint8)
+        return bases.tobytes().decode('ascii')
+
+    @property
+    def sequence(self):
+        """The whole sequence as a string (unpacked on every use)."""
+        return self.fetch()
+
+    def __str__(self):
+        return self.fetch()
+
+    def reverse(self):
+        """Return the reverse complement of the sequence."""
+        return reverse_complement(self.fetch())
+
+    def find_orfs(self, min_length=0, starts=('ATG',), nested=False):
+        """Return ORF coordinates on both strands, see find_orfs."""
+        return find_orfs(self.fetch(), min_length, starts, nested)
+
+    def orf_sequence(self, orf):
+        """Return the bases of an ORF given as (frame, strand, start, end), read on its own strand."""
+        frame, strand, start, end = orf
+        bases = self.fetch(start, end)
+        return bases if strand == '+' else reverse_complement(bases)
+
+    def get_long(self, min_length=0, starts=('ATG',)):
+        """Find the longest ORF on both strands; its coordinates are kept in longest_orf_coords."""
+        orfs = self.find_orfs(min_length, starts)
+        self.longest_orf_coords = max(orfs, key=lambda orf: orf[3] - orf[2], default=())
+        return self.longest_orf
+
+    @property
+    def longest_orf(self):
+        """Bases of the longest ORF, unpacked from its coordinates."""
+        if self.longest_orf_coords is None:
+            self.get_long()
+        return self.orf_sequence(self.longest_orf_coords) if self.longest_orf_coords else ''
+
+    def convert(self, table=None):
+        """Translate the longest ORF into a protein sequence (self.genetic_code unless a table is given)."""
+        self.converted = translate(self.longest_orf, self.genetic_code if table is None else table)
+        return self.converted
+
+    def get_orf(self):
+        """Return translated ORF (protein sequence)."""
+        return self.converted if self.converted else ''
+
+
+def _longest_orfs(chunk, min_length, starts, table):
+    #Worker for orf_batch: longest ORF and its protein for each (header, sequence) of a chunk
+    results = []
+    for header, sequence in chunk:
+        s = Sequence(sequence)
+        s.get_long(min_length, starts)
+        results.append((header, s.longest_orf_coords, s.convert(table) if s.longest_orf_coords else ''))
+    return results
+
+
+@profiling.timed('orf_batch')
+def orf_batch(filename, protein_out, table_out=None, processes=None, chunksize=256,
+              min_length=0, starts=('ATG',), table=1):
+    """Find the longest ORF of every record of a FASTA file and write its protein, in parallel.
+
+    Records are streamed with fasta_iter, grouped in chunks of chunksize and
+    handed to a pool of processes. At most two chunks per process are in
+    flight at a time, so memory stays bounded however large the file is, and
+    results are written in input order as soon as they are ready.
+
+    protein_out: path of the protein FASTA (same headers; records without an ORF are left out)
+    table_out: optional path of a TSV with id, frame, strand, start, end and length of each
+    longest ORF (0-based, end excluded; '.' for records without an ORF)
+    processes: number of worker processes, default is the number of cores
+    min_length, starts: passed to find_orfs; table: NCBI translation table
+    Returns the number of records processed."""
+    import os
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    #Checked here, so an unknown table fails before any output file or worker process is made
+    if table not in NCBI_GENETIC_CODES:
+        raise ValueError("unknown NCBI translation table %r" % (table,))
+    processes = processes or os.cpu_count() or 1
+    records = fasta_iter(filename)
+    count = 0
+
+    def chunks():
+        chunk = []
+        for header, sequence in records:
+            chunk.append((header or '', sequence))
+            if len(chunk) == chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    with open(protein_out, 'w') as proteins, \
+            (open(table_out, 'w') if table_out else open(os.devnull, 'w')) as coords, \
+            ProcessPoolExecutor(max_workers=processes) as pool:
+        coords.write('id\tframe\tstrand\tstart\tend\tlength\n')
+        pending = deque()
+
+        def write_oldest():
+            lines, rows = [], []
+            with profiling.stage('wait_results'):
+                results = pending.popleft().result()
+            for header, orf, protein in results:
+                name = header.split(None, 1)[0] if header.strip() else ''
+                if orf:
+                    frame, strand, start, end = orf
+                    lines.append('>%s\n%s\n' % (header, protein))
+                    rows.append('%s\t%d\t%s\t%d\t%d\t%d\n' % (name, frame, strand, start, end, end - start))
+                else:
+                    rows.append('%s\t.\t.\t.\t.\t0\n' % name)
+            with profiling.stage('write_output'):
+                proteins.write(''.join(lines))
+                coords.write(''.join(rows))
+            return len(rows)
+
+        for chunk in chunks():
+            pending.append(pool.submit(_longest_orfs, chunk, min_length, starts, table))
+            if len(pending) >= 2 * processes:
+                count += write_oldest()
+        while pending:
+            count += write_oldest()
+    profiling.count_file('fasta_bytes', filename)
+    profiling.count('records', count)
+    return count
+
+
+if __name__ == "__main__":
+    #To run only on command line:
+    import argparse #So that arguments can be parsed
+
+    parser = argparse.ArgumentParser(description="Longest ORF and its protein for every record of a FASTA file")
+    parser.add_argument("-i", "--input", help="Please provide path to the FASTA file (plain or gzip)", required=True)
+    parser.add_argument("-o", "--output", help="Path of the protein FASTA to write", required=True)
+    parser.add_argument("-t", "--table-output", help="Optional path of a TSV with the ORF coordinates")
+    parser.add_argument("-p", "--processes", help="Number of worker processes (default: all cores)", type=int)
+    parser.add_argument("--chunk-size", help="Records per task (default 256)", type=int, default=256)
+    parser.add_argument("--min-length", help="Smallest ORF to consider, in bases", type=int, default=0)
+    parser.add_argument("--starts", help="Comma separated start codons (default ATG)", default="ATG")
+    parser.add_argument("--genetic-code", help="NCBI translation table number (default 1)", type=int, default=1,
+                        choices=sorted(NCBI_GENETIC_CODES), metavar="TABLE")
+    #--profile, --profile-cprofile and --profile-memory
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("seq_tools", args):
+        n = orf_batch(args.input, args.output, args.table_output, args.processes, args.chunk_size,
+                      args.min_length, tuple(args.starts.upper().split(",")), args.genetic_code)
+    print("Longest ORFs of %d records have been written to %s" % (n, args.output))